@@ -1,16 +1,32 @@
 # Functions for calculating diffraction patterns, matching them to experiments, and creating orientation and phase maps.
 
+import math
+import functools
 import numpy as np
+import numba as nb
 import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 from matplotlib.axes import Axes
 from mpl_toolkits.mplot3d import Axes3D, art3d
 import warnings
+import threading
 from typing import Union, Optional
+from scipy.spatial import cKDTree
+import scipy.fft as sfft
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
 
 from ...io.datastructure import PointList, PointListArray
 from ..utils import tqdmnd, single_atom_scatter, electron_wavelength_angstrom
 
+# Structure factors keyed by (positions, numbers, cell, k_max, tol_structure_factor),
+# shared between all Crystal instances in the session
+_structure_factor_cache = {}
+_structure_factor_cache_size = 8
+
+# Per-thread polar Bragg peak image buffers, reused between calls to match_single_pattern
+_polar_image_buffers = threading.local()
+
 
 class Crystal:
     """
@@ -46,32 +62,35 @@ class Crystal:
             raise Exception("Number of positions and atomic numbers do not match")
 
         # unit cell, as either [a a a 90 90 90], [a b c 90 90 90], or [a b c alpha beta gamma]
-        cell = np.asarray(cell, dtype="float_")
-        if np.size(cell) == 1:
-            self.cell = np.hstack([cell, cell, cell, 90, 90, 90])
-        elif np.size(cell) == 3:
-            self.cell = np.hstack([cell, 90, 90, 90])
-        elif np.size(cell) == 6:
+        cell = np.asarray(cell, dtype="float_").ravel()
+        if cell.size == 1:
+            self.cell = np.array([cell[0], cell[0], cell[0], 90.0, 90.0, 90.0])
+        elif cell.size == 3:
+            self.cell = np.array([cell[0], cell[1], cell[2], 90.0, 90.0, 90.0])
+        elif cell.size == 6:
             self.cell = cell
         else:
-            raise Exception("Cell cannot contain " + np.size(cell) + " elements")
+            raise Exception("Cell cannot contain " + str(cell.size) + " elements")
 
         # calculate unit cell lattice vectors
-        a = self.cell[0]
-        b = self.cell[1]
-        c = self.cell[2]
-        alpha = self.cell[3] * np.pi / 180
-        beta = self.cell[4] * np.pi / 180
-        gamma = self.cell[5] * np.pi / 180
-        t = (np.cos(alpha) - np.cos(beta) * np.cos(gamma)) / np.sin(gamma)
+        a, b, c = self.cell[:3]
+        alpha = math.radians(self.cell[3])
+        beta = math.radians(self.cell[4])
+        gamma = math.radians(self.cell[5])
+        cos_beta = math.cos(beta)
+        t = (math.cos(alpha) - cos_beta * math.cos(gamma)) / math.sin(gamma)
         self.lat_real = np.array(
             [
                 [a, 0, 0],
-                [b * np.cos(gamma), b * np.sin(gamma), 0],
-                [c * np.cos(beta), c * t, c * np.sqrt(1 - np.cos(beta) ** 2 - t ** 2)],
+                [b * math.cos(gamma), b * math.sin(gamma), 0],
+                [c * cos_beta, c * t, c * math.sqrt(1 - cos_beta ** 2 - t ** 2)],
             ]
         )
 
+        # reciprocal lattice vectors, and the reciprocal metric tensor giving |g|^2 from hkl
+        self.lat_inv = np.linalg.inv(self.lat_real)
+        self.metric_inv = self.lat_inv.T @ self.lat_inv
+
     def from_CIF(CIF, conventional_standard_structure=True):
         """
         Create a Crystal object from a CIF file, using pymatgen to import the CIF
@@ -307,6 +326,7 @@ class Crystal:
         k_max: float = 2.0,
         tol_structure_factor: float = 1e-2,
         return_intensities: bool = False,
+        CUDA: bool = False,
     ):
         """
         Calculate structure factors for all hkl indices up to max scattering vector k_max
@@ -314,83 +334,160 @@ class Crystal:
         Args:
             k_max (numpy float):                max scattering vector to include (1/Angstroms)
             tol_structure_factor (numpy float): tolerance for removing low-valued structure factors
+            CUDA (bool):                        compute the structure factors on the GPU with cupy
         """
 
         # Store k_max
         self.k_max = np.asarray(k_max)
 
-        # Inverse lattice vectors
-        lat_inv = np.linalg.inv(self.lat_real)
-
-        # Find shortest lattice vector direction
-        k_test = np.vstack(
-            [
-                lat_inv[0, :],
-                lat_inv[1, :],
-                lat_inv[2, :],
-                lat_inv[0, :] + lat_inv[1, :],
-                lat_inv[0, :] + lat_inv[2, :],
-                lat_inv[1, :] + lat_inv[2, :],
-                lat_inv[0, :] + lat_inv[1, :] + lat_inv[2, :],
-                lat_inv[0, :] - lat_inv[1, :] + lat_inv[2, :],
-                lat_inv[0, :] + lat_inv[1, :] - lat_inv[2, :],
-                lat_inv[0, :] - lat_inv[1, :] - lat_inv[2, :],
-            ]
-        )
-        k_leng_min = np.min(np.linalg.norm(k_test, axis=1))
-
-        # Tile lattice vectors
-        num_tile = np.ceil(self.k_max / k_leng_min)
-        ya, xa, za = np.meshgrid(
-            np.arange(-num_tile, num_tile + 1),
-            np.arange(-num_tile, num_tile + 1),
-            np.arange(-num_tile, num_tile + 1),
-        )
-        hkl = np.vstack([xa.ravel(), ya.ravel(), za.ravel()])
-        g_vec_all = lat_inv @ hkl
-
-        # Delete lattice vectors outside of k_max
-        keep = np.linalg.norm(g_vec_all, axis=0) <= self.k_max
-        self.hkl = hkl[:, keep]
-        self.g_vec_all = g_vec_all[:, keep]
-        self.g_vec_leng = np.linalg.norm(self.g_vec_all, axis=0)
-
-        # Calculate single atom scattering factors
-        # Note this can be sped up a lot, but we may want to generalize to allow non-1.0 occupancy in the future.
-        f_all = np.zeros(
-            (np.size(self.g_vec_leng, 0), self.positions.shape[0]), dtype="float_"
+        # Reuse previously calculated structure factors for an identical crystal and k_max
+        cache_key = (
+            np.asarray(self.positions, dtype="float64").tobytes(),
+            self.numbers.tobytes(),
+            self.cell.tobytes(),
+            float(k_max),
+            float(tol_structure_factor),
         )
-        for a0 in range(self.positions.shape[0]):
-            atom_sf = single_atom_scatter([self.numbers[a0]], [1], self.g_vec_leng, "A")
-            atom_sf.get_scattering_factor([self.numbers[a0]], [1], self.g_vec_leng, "A")
-            f_all[:, a0] = atom_sf.fe
-
-        # Calculate structure factors
-        self.struct_factors = np.zeros(np.size(self.g_vec_leng, 0), dtype="complex64")
-        for a0 in range(self.positions.shape[0]):
-            self.struct_factors += f_all[:, a0] * np.exp(
-                (2j * np.pi)
-                * np.sum(
-                    self.hkl * np.expand_dims(self.positions[a0, :], axis=1), axis=0
+        if cache_key in _structure_factor_cache:
+            (
+                self.hkl,
+                self.g_vec_all,
+                self.g_vec_leng,
+                self.struct_factors,
+                self.struct_factors_int,
+            ) = (v.copy() for v in _structure_factor_cache[cache_key])
+        else:
+            # Inverse lattice vectors
+            lat_inv = self.lat_inv
+
+            # Find shortest lattice vector direction
+            k_test = (
+                np.array(
+                    [
+                        [1, 0, 0],
+                        [0, 1, 0],
+                        [0, 0, 1],
+                        [1, 1, 0],
+                        [1, 0, 1],
+                        [0, 1, 1],
+                        [1, 1, 1],
+                        [1, -1, 1],
+                        [1, 1, -1],
+                        [1, -1, -1],
+                    ]
                 )
+                @ lat_inv
             )
+            k_leng_min = np.sqrt(np.min(np.einsum("ij,ij->i", k_test, k_test)))
+
+            # Tile lattice vectors
+            num_tile = int(np.ceil(self.k_max / k_leng_min))
+            inds_tile = np.arange(-num_tile, num_tile + 1)
+            h = inds_tile[:, None, None]
+            k = inds_tile[None, :, None]
+            l = inds_tile[None, None, :]
+
+            # Delete lattice vectors outside of k_max, testing their lengths with the
+            # reciprocal metric tensor broadcast over the 1D index ranges, and only
+            # forming the hkl indices and lattice vectors of those inside k_max
+            m = self.metric_inv
+            g_vec_sq = (
+                (m[0, 0] * h + 2 * m[0, 1] * k + 2 * m[0, 2] * l) * h
+                + (m[1, 1] * k + 2 * m[1, 2] * l) * k
+                + m[2, 2] * l ** 2
+            )
+            keep = np.nonzero(g_vec_sq <= self.k_max ** 2)
+            self.hkl = np.vstack([inds_tile[keep[0]], inds_tile[keep[1]], inds_tile[keep[2]]])
+            self.g_vec_all = lat_inv @ self.hkl
+            self.g_vec_leng = np.sqrt(g_vec_sq[keep])
+
+            # Calculate single atom scattering factors, once for each unique atomic species
+            # Note we may want to generalize to allow non-1.0 occupancy in the future.
+            numbers_unique, numbers_inverse = np.unique(self.numbers, return_inverse=True)
+            f_unique = np.zeros(
+                (np.size(self.g_vec_leng, 0), numbers_unique.size), dtype="float32"
+            )
+            atom_sf = single_atom_scatter()
+            for a0 in range(numbers_unique.size):
+                atom_sf.get_scattering_factor([numbers_unique[a0]], [1], self.g_vec_leng, "A")
+                f_unique[:, a0] = atom_sf.fe
+
+            # Indicator matrix assigning each atom to its atomic species
+            species = (
+                numbers_inverse[:, None] == np.arange(numbers_unique.size)[None, :]
+            ).astype("complex64")
+
+            # Calculate structure factors, summing the phase factors of each species with a
+            # matrix product before weighting by its scattering factor. Each block of hkl
+            # indices is sized to keep the phase factors cache resident, and phases are
+            # evaluated in single precision, matching the complex64 output.
+            if CUDA:
+                import cupy as cp
+
+                # Calculate all structure factors at once on the GPU
+                hkl_rows = cp.asarray(self.hkl.T, dtype="float32")
+                positions = cp.asarray(self.positions.T, dtype="float32")
+                self.struct_factors = cp.asnumpy(
+                    cp.einsum(
+                        "gs,gs->g",
+                        cp.asarray(f_unique),
+                        cp.exp(cp.complex64(2j * np.pi) * (hkl_rows @ positions))
+                        @ cp.asarray(species),
+                    )
+                )
+            else:
+                self.struct_factors = np.zeros(
+                    np.size(self.g_vec_leng, 0), dtype="complex64"
+                )
+                # The phase factors separate into products of 1D tables over each index,
+                # exp(2 pi i (h x + k y + l z)) = exp(2 pi i h x) exp(2 pi i k y) exp(2 pi i l z)
+                phase_tables = np.exp(
+                    (2j * np.pi) * inds_tile[None, :, None] * self.positions.T[:, None, :]
+                ).astype("complex64")
+                hkl_inds = self.hkl + num_tile
+
+                block_size = max(32768 // self.positions.shape[0], 1)
+                phase = np.empty((block_size, self.positions.shape[0]), dtype="complex64")
+                for a0 in range(0, self.struct_factors.size, block_size):
+                    sub = slice(a0, a0 + block_size)
+                    # Assemble the phase factors in place in a reused buffer
+                    phase_sub = phase[: hkl_inds[0, sub].size]
+                    np.take(phase_tables[0], hkl_inds[0, sub], axis=0, out=phase_sub)
+                    phase_sub *= phase_tables[1][hkl_inds[1, sub]]
+                    phase_sub *= phase_tables[2][hkl_inds[2, sub]]
+                    self.struct_factors[sub] = np.einsum(
+                        "gs,gs->g", f_unique[sub], phase_sub @ species
+                    )
 
-        # Remove structure factors below tolerance level
-        keep = np.abs(self.struct_factors) > tol_structure_factor
-        self.hkl = self.hkl[:, keep]
-        self.g_vec_all = self.g_vec_all[:, keep]
-        self.g_vec_leng = self.g_vec_leng[keep]
-        self.struct_factors = self.struct_factors[keep]
-
-        # Structure factor intensities
-        self.struct_factors_int = np.abs(self.struct_factors) ** 2
+            # Remove structure factors below tolerance level
+            keep = np.abs(self.struct_factors) > tol_structure_factor
+            self.hkl = self.hkl[:, keep]
+            self.g_vec_all = self.g_vec_all[:, keep]
+            self.g_vec_leng = self.g_vec_leng[keep]
+            self.struct_factors = self.struct_factors[keep]
+
+            # Structure factor intensities
+            self.struct_factors_int = np.abs(self.struct_factors) ** 2
+
+            # Store results, discarding the oldest entry when the cache is full
+            if len(_structure_factor_cache) >= _structure_factor_cache_size:
+                del _structure_factor_cache[next(iter(_structure_factor_cache))]
+            _structure_factor_cache[cache_key] = (
+                self.hkl.copy(),
+                self.g_vec_all.copy(),
+                self.g_vec_leng.copy(),
+                self.struct_factors.copy(),
+                self.struct_factors_int.copy(),
+            )
 
         if return_intensities:
             q_SF = np.linspace(0, self.k_max, 250)
-            I_SF = np.zeros_like(q_SF)
-            for i in range(self.g_vec_leng.shape[0]):
-                idx = np.argmin(np.abs(q_SF - self.g_vec_leng[i]))
-                I_SF[idx] += self.struct_factors_int[i]
+            # Add each intensity to the nearest q_SF bin (ties go to the lower bin)
+            inds = np.clip(np.searchsorted(q_SF, self.g_vec_leng), 1, q_SF.size - 1)
+            inds -= (self.g_vec_leng - q_SF[inds - 1]) <= (q_SF[inds] - self.g_vec_leng)
+            I_SF = np.bincount(
+                inds, weights=self.struct_factors_int, minlength=q_SF.size
+            )
             I_SF = I_SF / np.max(I_SF)
 
             return (q_SF, I_SF)
@@ -545,10 +642,10 @@ class Crystal:
         if camera_dist is not None:
             ax.dist = camera_dist
 
-        plt.show()
-
         if returnfig:
             return fig, ax
+        else:
+            plt.show()
 
     def plot_structure_factors(
         self,
@@ -618,10 +715,10 @@ class Crystal:
         # ax.setxticklabels([])
         # fig.subplots_adjust(left=0, right=1, bottom=0, top=1)
 
-        plt.show()
-
         if returnfig:
             return fig, ax
+        else:
+            plt.show()
 
     def orientation_plan(
         self,
@@ -638,7 +735,8 @@ class Crystal:
         fiber_angles=None,
         cartesian_directions=False,
         figsize: Union[list, tuple, np.ndarray] = (6, 6),
-        progress_bar: bool = True
+        progress_bar: bool = True,
+        CUDA: bool = False,
     ):
         # plot_corr_norm: bool = False,  # option removed due to new normalization
 
@@ -670,6 +768,13 @@ class Crystal:
                                          are specified in Cartesian directions.
             figsize (float):            (2,) vector giving the figure size
             progress_bar (bool):    If false no progress bar is displayed
+            CUDA (bool):            compute the orientation reference arrays on the GPU with cupy
+
+        The orientation references are stored in Fourier space along the in-plane angle, as
+        orientation_ref_rfft: the complex conjugate of their real FFT, keeping only the
+        non-negative frequencies, with shape (num_zones, num_radii, in_plane_steps // 2 + 1).
+        The angular references are recovered with
+        np.fft.irfft(np.conj(orientation_ref_rfft), n=orientation_in_plane_steps).
         """
 
         # Store inputs
@@ -807,56 +912,31 @@ class Crystal:
         else:
             self.orientation_zone_axis_range = np.array(zone_axis_range, dtype="float")
 
+            # Convert all basis vectors at once
             if not self.cartesian_directions:
-                for a0 in range(zone_axis_range.shape[0]):
-                    self.orientation_zone_axis_range[a0, :] = self.crystal_to_cartesian(
-                        self.orientation_zone_axis_range[a0, :]
-                    )
-
-            # Define 3 vectors which span zone axis orientation range, normalize
-            if zone_axis_range.shape[0] == 3:
-                self.orientation_zone_axis_range = np.array(
-                    self.orientation_zone_axis_range, dtype="float"
-                )
-                self.orientation_zone_axis_range[0, :] /= np.linalg.norm(
-                    self.orientation_zone_axis_range[0, :]
-                )
-                self.orientation_zone_axis_range[1, :] /= np.linalg.norm(
-                    self.orientation_zone_axis_range[1, :]
-                )
-                self.orientation_zone_axis_range[2, :] /= np.linalg.norm(
-                    self.orientation_zone_axis_range[2, :]
+                self.orientation_zone_axis_range = (
+                    self.orientation_zone_axis_range @ self.lat_inv
                 )
 
-            elif zone_axis_range.shape[0] == 2:
+            # Define 3 vectors which span zone axis orientation range, normalize
+            if zone_axis_range.shape[0] == 2:
                 self.orientation_zone_axis_range = np.vstack(
                     (
                         np.array([0, 0, 1]),
-                        np.array(self.orientation_zone_axis_range, dtype="float"),
+                        self.orientation_zone_axis_range,
                     )
                 ).astype("float")
-                self.orientation_zone_axis_range[1, :] /= np.linalg.norm(
-                    self.orientation_zone_axis_range[1, :]
-                )
-                self.orientation_zone_axis_range[2, :] /= np.linalg.norm(
-                    self.orientation_zone_axis_range[2, :]
-                )
+            self.orientation_zone_axis_range /= np.linalg.norm(
+                self.orientation_zone_axis_range, axis=1
+            )[:, None]
             self.orientation_full = False
             self.orientation_half = False
             self.orientation_fiber = False
 
         # Solve for number of angular steps in zone axis (rads)
-        angle_u_v = np.arccos(
-            np.sum(
-                self.orientation_zone_axis_range[0, :]
-                * self.orientation_zone_axis_range[1, :]
-            )
-        )
-        angle_u_w = np.arccos(
-            np.sum(
-                self.orientation_zone_axis_range[0, :]
-                * self.orientation_zone_axis_range[2, :]
-            )
+        angle_u_v, angle_u_w = np.arccos(
+            self.orientation_zone_axis_range[1:, :]
+            @ self.orientation_zone_axis_range[0, :]
         )
         self.orientation_zone_axis_steps = np.round(
             np.maximum(
@@ -876,23 +956,17 @@ class Crystal:
             # Generate points spanning the zone axis range
             # Calculate points along u and v using the SLERP formula
             # https://en.wikipedia.org/wiki/Slerp
-            weights = np.linspace(0, 1, self.orientation_zone_axis_steps + 1)
-            pv = self.orientation_zone_axis_range[0, :] * np.sin(
-                (1 - weights[:, None]) * angle_u_v
-            ) / np.sin(angle_u_v) + self.orientation_zone_axis_range[1, :] * np.sin(
-                weights[:, None] * angle_u_v
-            ) / np.sin(
-                angle_u_v
-            )
+            weights = np.linspace(0, 1, self.orientation_zone_axis_steps + 1)[:, None]
+            pv = (
+                self.orientation_zone_axis_range[0, :] * np.sin((1 - weights) * angle_u_v)
+                + self.orientation_zone_axis_range[1, :] * np.sin(weights * angle_u_v)
+            ) * (1 / np.sin(angle_u_v))
 
             # Calculate points along u and w using the SLERP formula
-            pw = self.orientation_zone_axis_range[0, :] * np.sin(
-                (1 - weights[:, None]) * angle_u_w
-            ) / np.sin(angle_u_w) + self.orientation_zone_axis_range[2, :] * np.sin(
-                weights[:, None] * angle_u_w
-            ) / np.sin(
-                angle_u_w
-            )
+            pw = (
+                self.orientation_zone_axis_range[0, :] * np.sin((1 - weights) * angle_u_w)
+                + self.orientation_zone_axis_range[2, :] * np.sin(weights * angle_u_w)
+            ) * (1 / np.sin(angle_u_w))
 
             # Init array to hold all points
             self.orientation_num_zones = (
@@ -906,56 +980,44 @@ class Crystal:
                 (self.orientation_num_zones, 3), dtype="int"
             )
 
-            # Calculate zone axis points on the unit sphere with another application of SLERP,
-            # or circular arc SLERP for fiber texture
-            for a0 in np.arange(1, self.orientation_zone_axis_steps + 1):
-                inds = np.arange(a0 * (a0 + 1) / 2, a0 * (a0 + 1) / 2 + a0 + 1).astype(
-                    np.int
-                )
-
-                p0 = pv[a0, :]
-                p1 = pw[a0, :]
-
-                weights = np.linspace(0, 1, a0 + 1)
+            # Row index a0 and position b along the row of each remaining point of the
+            # triangle, where row a0 contains the a0 + 1 points between pv[a0] and pw[a0]
+            inds_row = np.repeat(
+                np.arange(1, self.orientation_zone_axis_steps + 1),
+                np.arange(2, self.orientation_zone_axis_steps + 2),
+            )
+            inds_col = np.arange(1, self.orientation_num_zones) - inds_row * (inds_row + 1) // 2
+            weights = (inds_col / inds_row)[:, None]
+            p0 = pv[inds_row, :]
+            p1 = pw[inds_row, :]
 
-                if self.orientation_fiber:
-                    # For fiber texture, place points on circular arc perpendicular to the fiber axis
-                    self.orientation_vecs[inds, :] = p0[None, :]
+            # Calculate zone axis points on the unit sphere with another application of SLERP,
+            # or circular arc SLERP for fiber texture, for all rows of the triangle at once
+            if self.orientation_fiber:
+                # For fiber texture, place points on circular arc perpendicular to the fiber axis
+                p_proj = (p0 @ self.orientation_fiber_axis)[:, None] * self.orientation_fiber_axis
+                p0_sub = p0 - p_proj
+                p1_sub = p1 - p_proj
+
+                angle_p_sub = np.arccos(
+                    np.einsum("ij,ij->i", p0_sub, p1_sub)
+                    / np.linalg.norm(p0_sub, axis=1)
+                    / np.linalg.norm(p1_sub, axis=1)
+                )[:, None]
+
+                self.orientation_vecs[1:, :] = p_proj + (
+                    p0_sub * np.sin((1 - weights) * angle_p_sub)
+                    + p1_sub * np.sin(weights * angle_p_sub)
+                ) * (1 / np.sin(angle_p_sub))
+            else:
+                angle_p = np.arccos(np.einsum("ij,ij->i", p0, p1))[:, None]
 
-                    p_proj = (
-                        np.dot(p0, self.orientation_fiber_axis)
-                        * self.orientation_fiber_axis
-                    )
-                    p0_sub = p0 - p_proj
-                    p1_sub = p1 - p_proj
-
-                    angle_p_sub = np.arccos(
-                        np.sum(p0_sub * p1_sub) \
-                        / np.linalg.norm(p0_sub) \
-                        / np.linalg.norm(p1_sub))
-
-                    self.orientation_vecs[inds, :] = (
-                        p_proj
-                        + p0_sub[None, :]
-                        * np.sin((1 - weights[:, None]) * angle_p_sub)
-                        / np.sin(angle_p_sub)
-                        + p1_sub[None, :]
-                        * np.sin(weights[:, None] * angle_p_sub)
-                        / np.sin(angle_p_sub)
-                    )
-                else:
-                    angle_p = np.arccos(np.sum(p0 * p1))
-
-                    self.orientation_vecs[inds, :] = p0[None, :] * np.sin(
-                        (1 - weights[:, None]) * angle_p
-                    ) / np.sin(angle_p) + p1[None, :] * np.sin(
-                        weights[:, None] * angle_p
-                    ) / np.sin(
-                        angle_p
-                    )
+                self.orientation_vecs[1:, :] = (
+                    p0 * np.sin((1 - weights) * angle_p) + p1 * np.sin(weights * angle_p)
+                ) * (1 / np.sin(angle_p))
 
-                self.orientation_inds[inds, 0] = a0
-                self.orientation_inds[inds, 1] = np.arange(a0 + 1)
+            self.orientation_inds[1:, 0] = inds_row
+            self.orientation_inds[1:, 1] = inds_col
 
 
         if (
@@ -968,19 +1030,8 @@ class Crystal:
             vec_new = np.copy(self.orientation_vecs) @ m
             orientation_sector = np.zeros(vec_new.shape[0], dtype="int")
 
-            keep = np.zeros(vec_new.shape[0], dtype="bool")
-            for a0 in range(keep.size):
-                if (
-                    np.sqrt(
-                        np.min(
-                            np.sum(
-                                (self.orientation_vecs - vec_new[a0, :]) ** 2, axis=1
-                            )
-                        )
-                    )
-                    > tol_distance
-                ):
-                    keep[a0] = True
+            # Keep the new points not already within tol_distance of an existing point
+            keep = cKDTree(self.orientation_vecs).query(vec_new)[0] > tol_distance
 
             self.orientation_vecs = np.vstack((self.orientation_vecs, vec_new[keep, :]))
             self.orientation_num_zones = self.orientation_vecs.shape[0]
@@ -1014,19 +1065,8 @@ class Crystal:
             vec_new = np.copy(self.orientation_vecs) @ m
             orientation_sector = np.zeros(vec_new.shape[0], dtype="int")
 
-            keep = np.zeros(vec_new.shape[0], dtype="bool")
-            for a0 in range(keep.size):
-                if (
-                    np.sqrt(
-                        np.min(
-                            np.sum(
-                                (self.orientation_vecs - vec_new[a0, :]) ** 2, axis=1
-                            )
-                        )
-                    )
-                    > tol_distance
-                ):
-                    keep[a0] = True
+            # Keep the new points not already within tol_distance of an existing point
+            keep = cKDTree(self.orientation_vecs).query(vec_new)[0] > tol_distance
 
             self.orientation_vecs = np.vstack((self.orientation_vecs, vec_new[keep, :]))
             self.orientation_num_zones = self.orientation_vecs.shape[0]
@@ -1056,19 +1096,8 @@ class Crystal:
             vec_new = np.copy(self.orientation_vecs) @ m
             orientation_sector = np.zeros(vec_new.shape[0], dtype="int")
 
-            keep = np.zeros(vec_new.shape[0], dtype="bool")
-            for a0 in range(keep.size):
-                if (
-                    np.sqrt(
-                        np.min(
-                            np.sum(
-                                (self.orientation_vecs - vec_new[a0, :]) ** 2, axis=1
-                            )
-                        )
-                    )
-                    > tol_distance
-                ):
-                    keep[a0] = True
+            # Keep the new points not already within tol_distance of an existing point
+            keep = cKDTree(self.orientation_vecs).query(vec_new)[0] > tol_distance
 
             self.orientation_vecs = np.vstack((self.orientation_vecs, vec_new[keep, :]))
             self.orientation_num_zones = self.orientation_vecs.shape[0]
@@ -1085,19 +1114,8 @@ class Crystal:
             vec_new = np.copy(self.orientation_vecs) * np.array([-1, 1, 1])
             orientation_sector = np.zeros(vec_new.shape[0], dtype="int")
 
-            keep = np.zeros(vec_new.shape[0], dtype="bool")
-            for a0 in range(keep.size):
-                if (
-                    np.sqrt(
-                        np.min(
-                            np.sum(
-                                (self.orientation_vecs - vec_new[a0, :]) ** 2, axis=1
-                            )
-                        )
-                    )
-                    > tol_distance
-                ):
-                    keep[a0] = True
+            # Keep the new points not already within tol_distance of an existing point
+            keep = cKDTree(self.orientation_vecs).query(vec_new)[0] > tol_distance
 
             self.orientation_vecs = np.vstack((self.orientation_vecs, vec_new[keep, :]))
             self.orientation_num_zones = self.orientation_vecs.shape[0]
@@ -1113,19 +1131,8 @@ class Crystal:
         if self.orientation_full:
             vec_new = np.copy(self.orientation_vecs) * np.array([1, -1, 1])
 
-            keep = np.zeros(vec_new.shape[0], dtype="bool")
-            for a0 in range(keep.size):
-                if (
-                    np.sqrt(
-                        np.min(
-                            np.sum(
-                                (self.orientation_vecs - vec_new[a0, :]) ** 2, axis=1
-                            )
-                        )
-                    )
-                    > tol_distance
-                ):
-                    keep[a0] = True
+            # Keep the new points not already within tol_distance of an existing point
+            keep = cKDTree(self.orientation_vecs).query(vec_new)[0] > tol_distance
 
             self.orientation_vecs = np.vstack((self.orientation_vecs, vec_new[keep, :]))
             self.orientation_num_zones = self.orientation_vecs.shape[0]
@@ -1157,134 +1164,196 @@ class Crystal:
             0, 2 * np.pi, self.orientation_in_plane_steps, endpoint=False
         )
 
-        # Determine the radii of all spherical shells
-        radii_test = np.round(self.g_vec_leng / tol_distance) * tol_distance
-        radii = np.unique(radii_test)
+        # Determine the radii of all spherical shells, as integer multiples of tol_distance,
+        # and assign each structure factor point to a radial shell
+        radii_inds, shell_index = np.unique(
+            np.rint(self.g_vec_leng / tol_distance).astype("int"), return_inverse=True
+        )
         # Remove zero beam
-        keep = np.abs(radii) > tol_distance
-        self.orientation_shell_radii = radii[keep]
-
-        # init
-        self.orientation_shell_index = -1 * np.ones(
-            self.g_vec_all.shape[1], dtype="int"
+        num_remove = np.count_nonzero(radii_inds * tol_distance <= tol_distance)
+        shell_index -= num_remove
+        shell_index[shell_index < 0] = -1
+        self.orientation_shell_index = shell_index
+
+        # Count the points in each shell, and set the shell radii to their mean radius
+        sub = shell_index >= 0
+        self.orientation_shell_count = np.bincount(
+            shell_index[sub], minlength=radii_inds.size - num_remove
         )
-        self.orientation_shell_count = np.zeros(self.orientation_shell_radii.size)
-
-        # Assign each structure factor point to a radial shell
-        for a0 in range(self.orientation_shell_radii.size):
-            sub = (
-                np.abs(self.orientation_shell_radii[a0] - radii_test)
-                <= tol_distance / 2
+        self.orientation_shell_radii = (
+            np.bincount(
+                shell_index[sub],
+                weights=self.g_vec_leng[sub],
+                minlength=radii_inds.size - num_remove,
             )
-
-            self.orientation_shell_index[sub] = a0
-            self.orientation_shell_count[a0] = np.sum(sub)
-            self.orientation_shell_radii[a0] = np.mean(self.g_vec_leng[sub])
+            / self.orientation_shell_count
+        )
 
         # init storage arrays
         self.orientation_rotation_angles = np.zeros((self.orientation_num_zones, 2))
         self.orientation_rotation_matrices = np.zeros(
             (self.orientation_num_zones, 3, 3)
         )
-        self.orientation_ref = np.zeros(
-            (
-                self.orientation_num_zones,
-                np.size(self.orientation_shell_radii),
-                self.orientation_in_plane_steps,
-            ),
-            dtype="complex64",
-        )
-        
-
 
-        # Calculate rotation matrices for zone axes
-        # for a0 in tqdmnd(np.arange(self.orientation_num_zones),desc='Computing orientation basis',unit=' terms',unit_scale=True):
-        for a0 in np.arange(self.orientation_num_zones):
-            m1z = np.array(
-                [
-                    [np.cos(azim[a0]), -np.sin(azim[a0]), 0],
-                    [np.sin(azim[a0]), np.cos(azim[a0]), 0],
-                    [0, 0, 1],
-                ]
+        # Calculate rotation matrices for all zone axes, as the product m1z @ m2x of
+        # a rotation by azim about z and a rotation by elev about x
+        cos_azim, sin_azim = np.cos(azim), np.sin(azim)
+        cos_elev, sin_elev = np.cos(elev), np.sin(elev)
+        self.orientation_rotation_matrices[:, 0, 0] = cos_azim
+        self.orientation_rotation_matrices[:, 0, 1] = -sin_azim * cos_elev
+        self.orientation_rotation_matrices[:, 0, 2] = -sin_azim * sin_elev
+        self.orientation_rotation_matrices[:, 1, 0] = sin_azim
+        self.orientation_rotation_matrices[:, 1, 1] = cos_azim * cos_elev
+        self.orientation_rotation_matrices[:, 1, 2] = cos_azim * sin_elev
+        self.orientation_rotation_matrices[:, 2, 1] = -sin_elev
+        self.orientation_rotation_matrices[:, 2, 2] = cos_elev
+        self.orientation_rotation_angles[:, 0] = azim
+        self.orientation_rotation_angles[:, 1] = elev
+
+        # Neighbors of each zone axis in the triangular zone axis grid, used for the subpixel
+        # refinement in match_single_pattern. Category 0 zone axes (the corners) are not
+        # refined, category 1 zone axes (the edges) are refined along the edge using
+        # neighbors [prev, post], and category 2 zone axes (the interior) are refined in
+        # 2D using neighbors [ind_1, ..., ind_6]. Unused neighbors point to the zone axis.
+        inds = np.arange(self.orientation_num_zones)
+        ind_x = np.floor(0.5 * np.sqrt(8.0 * inds + 1) - 0.5).astype("int")
+        ind_y = inds - np.floor(ind_x * (ind_x + 1) / 2).astype("int")
+        max_x = ind_x[-1]
+
+        def sub_to_ind(ind_x, ind_y):
+            return (np.floor(ind_x * (ind_x + 1) / 2) + ind_y).astype("int")
+
+        self.orientation_subpixel_category = np.full(self.orientation_num_zones, 2)
+        self.orientation_subpixel_neighbors = np.vstack(
+            (
+                sub_to_ind(ind_x - 1, ind_y - 1),
+                sub_to_ind(ind_x - 1, ind_y),
+                sub_to_ind(ind_x, ind_y - 1),
+                sub_to_ind(ind_x, ind_y + 1),
+                sub_to_ind(ind_x + 1, ind_y),
+                sub_to_ind(ind_x + 1, ind_y + 1),
             )
-            m2x = np.array(
+        ).T
+        edges = (
+            (ind_x == ind_y, sub_to_ind(ind_x - 1, ind_y - 1), sub_to_ind(ind_x + 1, ind_y + 1)),
+            (ind_x == max_x, sub_to_ind(max_x, ind_y - 1), sub_to_ind(max_x, ind_y + 1)),
+            (ind_y == 0, sub_to_ind(ind_x - 1, 0), sub_to_ind(ind_x + 1, 0)),
+        )
+        for sub, ind_prev, ind_post in edges:
+            self.orientation_subpixel_category[sub] = 1
+            self.orientation_subpixel_neighbors[sub] = inds[sub, None]
+            self.orientation_subpixel_neighbors[sub, 0] = ind_prev[sub]
+            self.orientation_subpixel_neighbors[sub, 1] = ind_post[sub]
+        self.orientation_subpixel_category[
+            np.any(self.orientation_subpixel_neighbors >= self.orientation_num_zones, axis=1)
+        ] = 0
+        self.orientation_subpixel_category[
+            np.isin(
+                inds,
                 [
-                    [1, 0, 0],
-                    [0, np.cos(elev[a0]), np.sin(elev[a0])],
-                    [0, -np.sin(elev[a0]), np.cos(elev[a0])],
-                ]
+                    0,
+                    self.orientation_num_zones - self.orientation_zone_axis_steps - 1,
+                    self.orientation_num_zones - 1,
+                ],
             )
-            self.orientation_rotation_matrices[a0, :, :] = m1z @ m2x
-            self.orientation_rotation_angles[a0, :] = [azim[a0], elev[a0]]
+        ] = 0
+        self.orientation_subpixel_neighbors[self.orientation_subpixel_category == 0] = inds[
+            self.orientation_subpixel_category == 0, None
+        ]
 
         # init
         k0 = np.array([0, 0, 1]) / self.wavelength
         dphi = self.orientation_gamma[1] - self.orientation_gamma[0]
 
-        # Calculate reference arrays for all orientations
-        for a0 in tqdmnd(
-            np.arange(self.orientation_num_zones),
-            desc="Orientation plan",
-            unit=" zone axes",
-            disable=not progress_bar
-        ):
-            p = (
-                np.linalg.inv(self.orientation_rotation_matrices[a0, :, :])
-                @ self.g_vec_all
-            )
-
-            # Excitation errors
-            cos_alpha = (k0[2, None] + p[2, :]) / np.linalg.norm(
-                k0[:, None] + p, axis=0
-            )
-            sg = (
-                (-0.5)
-                * np.sum((2 * k0[:, None] + p) * p, axis=0)
-                / (np.linalg.norm(k0[:, None] + p, axis=0))
-                / cos_alpha
-            )
-
-            # in-plane rotation angle
-            phi = np.arctan2(p[1, :], p[0, :])
-
-            for a1 in np.arange(self.g_vec_all.shape[1]):
-                ind_radial = self.orientation_shell_index[a1]
-
-                if ind_radial >= 0:
-                    self.orientation_ref[a0, ind_radial, :] += (
-                        np.power(self.orientation_shell_radii[ind_radial], radial_power)
-                        * np.power(self.struct_factors_int[a1], intensity_power)
-                        * np.maximum(
-                            1
-                            - np.sqrt(
-                                sg[a1] ** 2
-                                + (
-                                    (
-                                        np.mod(
-                                            self.orientation_gamma - phi[a1] + np.pi,
-                                            2 * np.pi,
-                                        )
-                                        - np.pi
-                                    )
-                                    * self.orientation_shell_radii[ind_radial]
-                                )
-                                ** 2
-                            )
-                            / self.orientation_kernel_size,
-                            0,
-                        )
-                    )
+        # Single precision rotation matrices for all zone axes
+        rotation_matrices = self.orientation_rotation_matrices.astype("float32")
+
+        # Single precision copies of the inputs to the reference array calculation
+        g_vec_all = self.g_vec_all.astype("float32")
+        shell_radii = self.orientation_shell_radii.astype("float32")
+        # Shell radius and kernel weight of each structure factor, evaluated once rather than
+        # per zone axis. Points outside all shells (index -1) are skipped by the kernel.
+        radius_g = shell_radii[self.orientation_shell_index]
+        weight_g = (
+            radius_g ** radial_power * self.struct_factors_int ** intensity_power
+        ).astype("float32")
+        gamma = self.orientation_gamma.astype("float32")
+
+        ref_shape = (
+            self.orientation_num_zones,
+            np.size(self.orientation_shell_radii),
+            self.orientation_in_plane_steps,
+        )
+
+        if CUDA:
+            import cupy as cp
 
-            # Normalization
-            self.orientation_ref[a0, :, :] = self.orientation_ref[a0, :, :] / np.sqrt(
-                np.sum(np.abs(self.orientation_ref[a0, :, :])**2)
+            # Calculate reference arrays for all orientations on the GPU, with one block
+            # per zone axis and one thread per in-plane angle bin
+            ref = cp.zeros(ref_shape, dtype=cp.float32)
+            kernel = cp.RawKernel(_orientation_ref_build_cuda, "orientation_ref_build")
+            kernel(
+                (self.orientation_num_zones,),
+                (min(self.orientation_in_plane_steps, 256),),
+                (
+                    ref,
+                    cp.asarray(rotation_matrices),
+                    cp.asarray(np.ascontiguousarray(g_vec_all)),
+                    cp.float32(k0[2]),
+                    cp.asarray(self.orientation_shell_index.astype("int64")),
+                    cp.asarray(radius_g),
+                    cp.asarray(weight_g),
+                    cp.asarray(gamma),
+                    cp.float32(self.orientation_kernel_size),
+                    cp.int64(g_vec_all.shape[1]),
+                    cp.int64(ref_shape[1]),
+                    cp.int64(ref_shape[2]),
+                ),
             )
 
-        # Maximum value
-        self.orientation_ref_max = np.max(np.real(self.orientation_ref))
+            # Normalization, maximum value and real Fourier transform along the angular
+            # axis, all kept on the device until the final download
+            ref /= cp.sqrt(cp.einsum("zrg,zrg->z", ref, ref))[:, None, None]
+            self.orientation_ref_max = float(cp.max(ref))
+            self.orientation_ref_rfft = cp.asnumpy(cp.conj(cp.fft.rfft(ref)))
 
-        # Fourier domain along angular axis
-        self.orientation_ref = np.conj(np.fft.fft(self.orientation_ref))
+        else:
+            orientation_ref = np.zeros(ref_shape, dtype="float32")
+
+            # Calculate reference arrays for all orientations, in blocks of zone axes
+            zone_block = 256
+            for a0 in tqdmnd(
+                np.arange(0, self.orientation_num_zones, zone_block),
+                desc="Orientation plan",
+                unit=" zone axis blocks",
+                disable=not progress_bar
+            ):
+                _orientation_ref_build(
+                    orientation_ref[a0 : a0 + zone_block],
+                    rotation_matrices[a0 : a0 + zone_block],
+                    g_vec_all,
+                    np.float32(k0[2]),
+                    self.orientation_shell_index,
+                    radius_g,
+                    weight_g,
+                    gamma,
+                    np.float32(self.orientation_kernel_size),
+                )
+
+            # Normalization of all zone axis references at once, reducing the squared
+            # references per zone axis without materializing them
+            orientation_ref /= np.sqrt(
+                np.einsum("zrg,zrg->z", orientation_ref, orientation_ref)
+            )[:, None, None]
+
+            # Maximum value
+            self.orientation_ref_max = np.max(orientation_ref)
+
+            # Fourier domain along angular axis, converting the real float32 references to
+            # complex64 in the transform and conjugating in place. The references are real,
+            # so only the non-negative frequencies are stored.
+            self.orientation_ref_rfft = sfft.rfft(orientation_ref, workers=-1)
+            np.conj(self.orientation_ref_rfft, out=self.orientation_ref_rfft)
        
         # # Init vectors for the 2D corr method
         # self.orientation_gamma_cos2 = np.cos(self.orientation_gamma)**2
@@ -1546,10 +1615,10 @@ class Crystal:
         # plt.gca().invert_yaxis()
         ax.view_init(elev=el, azim=90 - az)
 
-        plt.show()
-
         if returnfig:
             return fig, ax
+        else:
+            plt.show()
 
     def plot_orientation_plan(
         self,
@@ -1576,9 +1645,8 @@ class Crystal:
         if zone_axis_plot is not None:
             zone_axis_plot = np.array(zone_axis_plot, dtype="float")
             zone_axis_plot = zone_axis_plot / np.linalg.norm(zone_axis_plot)
-            index_plot = np.argmin(
-                np.sum((self.orientation_vecs - zone_axis_plot) ** 2, axis=1)
-            )
+            # All zone axes are unit vectors, so the nearest has the largest dot product
+            index_plot = np.argmax(self.orientation_vecs @ zone_axis_plot)
             print('Orientation plan index ' + str(index_plot))
 
         # initialize figure
@@ -1613,8 +1681,10 @@ class Crystal:
         #     # ).astype("float"),
         #     #     self.orientation_ref_perp[index_plot, :, :])) / self.orientation_ref_max
         # else:
-        im_plot = np.real(
-            np.fft.ifft(self.orientation_ref[index_plot, :, :], axis=1)
+        im_plot = np.fft.irfft(
+            self.orientation_ref_rfft[index_plot, :, :],
+            n=self.orientation_in_plane_steps,
+            axis=1,
         ).astype("float") / self.orientation_ref_max
 
         # coordinates
@@ -1664,10 +1734,10 @@ class Crystal:
         )
 
         # plt.tight_layout()
-        plt.show()
-
         if returnfig:
             return fig, ax
+        else:
+            plt.show()
 
     def match_orientations(
         self,
@@ -1677,8 +1747,28 @@ class Crystal:
         multiple_corr_reset = True,
         return_corr: bool = False,
         subpixel_tilt: bool = False,
-        progress_bar: bool = True
+        progress_bar: bool = True,
+        num_threads: int = 1,
     ):
+        """
+        Solve for the best fit orientation of every diffraction pattern in a PointListArray.
+
+        Args:
+            bragg_peaks_array (PointListArray): Bragg peaks for each probe position
+            num_matches_return (int):     return these many matches as 4th dim of orient (matrix)
+            inversion_symmetry (bool):    check for inversion symmetry in the matches
+            multiple_corr_reset (bool):   keep original correlation score for multiple matches
+            return_corr (bool):           also return the correlation values
+            subpixel_tilt (bool):         set to false for faster matching, returning the nearest corr point
+            progress_bar (bool):          If false no progress bar is displayed
+            num_threads (int):            number of worker threads used to match probe positions
+                                          in parallel. The FFTs and array products release the GIL,
+                                          and the orientation plan is shared between threads.
+
+        Returns:
+            orientation_matrices (array):   orientation matrices for each probe position
+            corr_all (array):               (optional) correlation values for each probe position
+        """
 
         if num_matches_return == 1:
             orientation_matrices = np.zeros(
@@ -1695,9 +1785,7 @@ class Crystal:
                     (*bragg_peaks_array.shape, num_matches_return), dtype=np.float64
                 )
 
-        for rx, ry in tqdmnd(
-            *bragg_peaks_array.shape, desc="Matching Orientations", unit=" PointList", disable=not progress_bar
-        ):
+        def match_position(rx, ry):
             bragg_peaks = bragg_peaks_array.get_pointlist(rx, ry)
 
             if return_corr:
@@ -1726,11 +1814,324 @@ class Crystal:
                     verbose=False,
                 )
 
+        if num_threads > 1:
+            # Each probe position writes to its own slice of the outputs, so the
+            # positions can be matched concurrently without locking
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                futures = [
+                    executor.submit(match_position, rx, ry)
+                    for rx, ry in np.ndindex(*bragg_peaks_array.shape)
+                ]
+                for future in tqdm(
+                    as_completed(futures),
+                    total=len(futures),
+                    desc="Matching Orientations",
+                    unit=" PointList",
+                    disable=not progress_bar,
+                ):
+                    future.result()
+        else:
+            for rx, ry in tqdmnd(
+                *bragg_peaks_array.shape, desc="Matching Orientations", unit=" PointList", disable=not progress_bar
+            ):
+                match_position(rx, ry)
+
+        if return_corr:
+            return orientation_matrices, corr_all
+        else:
+            return orientation_matrices
+
+    def match_orientations_batched(
+        self,
+        bragg_peaks_array: PointListArray,
+        inversion_symmetry = True,
+        return_corr: bool = False,
+        batch_size: int = 8,
+        progress_bar: bool = True,
+        CUDA: bool = False,
+    ):
+        """
+        Solve for the best fit orientation of every diffraction pattern in a PointListArray,
+        processing several probe positions at a time. The polar images of each batch are
+        transformed with a single rfft call and correlated with the orientation references
+        together. Returns the same result as match_orientations with num_matches_return=1
+        and subpixel_tilt=False.
+
+        Args:
+            bragg_peaks_array (PointListArray): Bragg peaks for each probe position
+            inversion_symmetry (bool):    check for inversion symmetry in the matches
+            return_corr (bool):           also return the correlation values
+            batch_size (int):             number of probe positions correlated together. Peak
+                                          memory scales with batch_size * num_zones * num_radii
+                                          * in_plane_steps.
+            progress_bar (bool):          If false no progress bar is displayed
+            CUDA (bool):                  build the polar images and correlate them on the GPU
+                                          with cupy. Only the correlogram rows of the best fit
+                                          zone axes are copied back to the host.
+
+        Returns:
+            orientation_matrices (array):   orientation matrices for each probe position
+            corr_all (array):               (optional) correlation values for each probe position
+        """
+        if CUDA:
+            import cupy as cp
+
+            # Orientation references stay on the device for the whole scan
+            orientation_ref = cp.asarray(self.orientation_ref_rfft)
+            shell_radii = cp.asarray(self.orientation_shell_radii.astype("float32"))
+            gamma = cp.asarray(self.orientation_gamma.astype("float32"))
+            kernel = cp.RawKernel(_polar_image_build_cuda, "polar_image_build")
+
+        orientation_matrices = np.zeros((*bragg_peaks_array.shape, 3, 3), dtype=np.float64)
+        corr_all = np.zeros(bragg_peaks_array.shape, dtype=np.float64)
+
+        positions = list(np.ndindex(*bragg_peaks_array.shape))
+        im_polar = np.zeros(
+            (
+                batch_size,
+                np.size(self.orientation_shell_radii),
+                self.orientation_in_plane_steps,
+            ),
+            dtype="float32",
+        )
+
+        # Stage the peaks of all probe positions as contiguous polar coordinate and
+        # intensity arrays, with offsets giving the range of peaks of each probe position
+        peaks = [bragg_peaks_array.get_pointlist(rx, ry).data for rx, ry in positions]
+        peak_offsets = np.zeros(len(positions) + 1, dtype="int64")
+        peak_offsets[1:] = np.cumsum([p.size for p in peaks])
+        qx = np.concatenate([p["qx"] for p in peaks]).astype("float64")
+        qy = np.concatenate([p["qy"] for p in peaks]).astype("float64")
+        all_qr = np.sqrt(qx ** 2 + qy ** 2)
+        all_qphi = np.arctan2(qy, qx)
+        all_intensity = np.concatenate([p["intensity"] for p in peaks]).astype("float64")
+        del peaks
+
+        if CUDA:
+            all_qr_gpu = cp.asarray(all_qr.astype("float32"))
+            all_qphi_gpu = cp.asarray(all_qphi.astype("float32"))
+            all_intensity_gpu = cp.asarray(all_intensity.astype("float32"))
+            peak_offsets_gpu = cp.asarray(peak_offsets)
+
+        for ind_start in tqdmnd(
+            range(0, len(positions), batch_size),
+            desc="Matching Orientations",
+            unit=" PointList batches",
+            disable=not progress_bar,
+        ):
+            batch = positions[ind_start : ind_start + batch_size]
+
+            if CUDA:
+                # Calculate polar Bragg peak images for the batch, with one block per probe
+                # position and radial shell
+                im_polar_gpu = cp.zeros(
+                    (len(batch), shell_radii.size, gamma.size), dtype=cp.float32
+                )
+                kernel(
+                    (len(batch), shell_radii.size),
+                    (min(gamma.size, 256),),
+                    (
+                        im_polar_gpu,
+                        all_qr_gpu,
+                        all_qphi_gpu,
+                        all_intensity_gpu,
+                        peak_offsets_gpu[ind_start : ind_start + len(batch) + 1],
+                        shell_radii,
+                        gamma,
+                        cp.float32(self.orientation_kernel_size),
+                        cp.float32(self.orientation_radial_power),
+                        cp.float32(self.orientation_intensity_power),
+                        cp.int64(shell_radii.size),
+                        cp.int64(gamma.size),
+                    ),
+                )
+
+                # Correlograms of the batch, summing over the radial shells in Fourier space
+                im_polar_fft = cp.fft.rfft(im_polar_gpu)
+                corr_full = cp.maximum(
+                    cp.fft.irfft(
+                        cp.einsum("zrk,brk->bzk", orientation_ref, im_polar_fft),
+                        n=self.orientation_in_plane_steps,
+                    ),
+                    0,
+                )
+                corr_max = cp.max(corr_full, axis=-1)
+                if inversion_symmetry:
+                    corr_full_inv = cp.maximum(
+                        cp.fft.irfft(
+                            cp.einsum("zrk,brk->bzk", orientation_ref, cp.conj(im_polar_fft)),
+                            n=self.orientation_in_plane_steps,
+                        ),
+                        0,
+                    )
+                    corr_max = cp.maximum(corr_max, cp.max(corr_full_inv, axis=-1))
+
+                # Only the best fit zone axis of each probe position needs the in-plane
+                # fit, so copy back just those correlogram rows
+                ind_best_fit_gpu = cp.argmax(corr_max, axis=1)
+                rows = cp.arange(len(batch))
+                corr_value, corr_in_plane_angle, corr_inv = self._orientation_in_plane_fit(
+                    cp.asnumpy(corr_full[rows, ind_best_fit_gpu])[:, None, :],
+                    cp.asnumpy(corr_full_inv[rows, ind_best_fit_gpu])[:, None, :]
+                    if inversion_symmetry else None,
+                )
+                corr_value = corr_value[:, 0]
+                corr_in_plane_angle = corr_in_plane_angle[:, 0]
+                corr_inv = corr_inv[:, 0]
+                ind_best_fit = cp.asnumpy(ind_best_fit_gpu)
+
+            else:
+                # Calculate polar Bragg peak images for the batch
+                im_polar[:] = 0
+                for a0 in range(len(batch)):
+                    ind_peaks = slice(
+                        peak_offsets[ind_start + a0], peak_offsets[ind_start + a0 + 1]
+                    )
+                    _polar_image_build(
+                        im_polar[a0],
+                        all_qr[ind_peaks],
+                        all_qphi[ind_peaks],
+                        all_intensity[ind_peaks],
+                        self.orientation_shell_radii,
+                        self.orientation_gamma,
+                        float(self.orientation_kernel_size),
+                        float(self.orientation_radial_power),
+                        float(self.orientation_intensity_power),
+                    )
+
+                # FFT along theta of all polar images in one call, and correlograms
+                im_polar_fft = sfft.rfft(im_polar[: len(batch)], workers=-1)
+                corr_full = self._orientation_correlogram(im_polar_fft)
+                if inversion_symmetry:
+                    corr_full_inv = self._orientation_correlogram(np.conj(im_polar_fft))
+                else:
+                    corr_full_inv = None
+                corr_value, corr_in_plane_angle, corr_inv = self._orientation_in_plane_fit(
+                    corr_full, corr_full_inv
+                )
+
+                # Values at the best fit zone axis of each probe position
+                ind_best_fit = np.argmax(corr_value, axis=1)
+                rows = np.arange(len(batch))
+                corr_value = corr_value[rows, ind_best_fit]
+                corr_in_plane_angle = corr_in_plane_angle[rows, ind_best_fit]
+                corr_inv = corr_inv[rows, ind_best_fit]
+
+            # Best fit orientation of each probe position, with in-plane rotation and
+            # inversion applied to the whole batch at once
+            cos_phi = np.cos(corr_in_plane_angle)
+            sin_phi = np.sin(corr_in_plane_angle)
+            m3z = np.zeros((len(batch), 3, 3))
+            m3z[:, 0, 0] = cos_phi
+            m3z[:, 0, 1] = sin_phi
+            m3z[:, 1, 0] = -sin_phi
+            m3z[:, 1, 1] = cos_phi
+            m3z[:, 2, 2] = np.where(corr_inv, -1, 1)
+            matrices = np.einsum(
+                "nij,njk->nik", self.orientation_rotation_matrices[ind_best_fit], m3z
+            )
+            matrices[corr_value <= 0] = self.orientation_rotation_matrices[0]
+
+            rx, ry = np.array(batch).T
+            orientation_matrices[rx, ry] = matrices
+            corr_all[rx, ry] = corr_value
+
         if return_corr:
             return orientation_matrices, corr_all
         else:
             return orientation_matrices
 
+    def _orientation_correlogram(
+        self,
+        im_polar_fft: np.ndarray,
+        workers: int = -1,
+    ):
+        """
+        Correlate one or more polar Bragg peak images with the orientation references
+        of all zone axes.
+
+        Args:
+            im_polar_fft (np.array):    rfft along the in-plane angle of the polar images,
+                                        with shape (..., num_radii, num_freq)
+            workers (int):              number of workers for the inverse FFT, -1 for all CPUs
+
+        Returns:
+            corr_full (np.array):       correlogram, with shape (..., num_zones, in_plane_steps)
+        """
+        # Only radial shells containing peaks contribute, so skip the empty shells in
+        # the product
+        active = np.any(
+            im_polar_fft != 0, axis=tuple(range(im_polar_fft.ndim - 2)) + (-1,)
+        )
+        if not np.any(active):
+            return np.zeros(
+                (*im_polar_fft.shape[:-2], self.orientation_num_zones, self.orientation_in_plane_steps),
+                dtype="float32",
+            )
+        orientation_ref = self.orientation_ref_rfft
+        if not np.all(active):
+            orientation_ref = orientation_ref[:, active]
+            im_polar_fft = im_polar_fft[..., active, :]
+
+        # The inverse transform is linear, so sum over the radial shells in Fourier space
+        # and take a single inverse transform per zone axis
+        return np.maximum(
+            sfft.irfft(
+                np.einsum("zrk,...rk->...zk", orientation_ref, im_polar_fft),
+                n=self.orientation_in_plane_steps,
+                workers=workers,
+            ),
+            0,
+        )
+
+    def _orientation_in_plane_fit(
+        self,
+        corr_full: np.ndarray,
+        corr_full_inv: Optional[np.ndarray] = None,
+    ):
+        """
+        Find the correlation score and subpixel in-plane angle of every zone axis.
+
+        Args:
+            corr_full (np.array):       correlogram, with shape (..., num_zones, in_plane_steps)
+            corr_full_inv (np.array):   correlogram of the inverse pattern, or None to skip
+                                        the inversion symmetry check
+
+        Returns:
+            corr_value (np.array):          correlation score, with shape (..., num_zones)
+            corr_in_plane_angle (np.array): in-plane rotation angle [radians]
+            corr_inv (np.array):            True where the inverse pattern correlates better
+        """
+        dphi = self.orientation_gamma[1] - self.orientation_gamma[0]
+
+        # Correlation score of each zone axis, from the inverse pattern where it is higher
+        ind_phi = np.argmax(corr_full, axis=-1)
+        corr_value = np.take_along_axis(corr_full, ind_phi[..., None], axis=-1)[..., 0]
+        if corr_full_inv is None:
+            corr_inv = np.zeros(corr_value.shape, dtype="bool")
+        else:
+            ind_phi_inv = np.argmax(corr_full_inv, axis=-1)
+            corr_value_inv = np.take_along_axis(
+                corr_full_inv, ind_phi_inv[..., None], axis=-1
+            )[..., 0]
+            corr_inv = corr_value_inv > corr_value
+            corr_value[corr_inv] = corr_value_inv[corr_inv]
+            ind_phi = np.where(corr_inv, ind_phi_inv, ind_phi)
+
+        # Subpixel angular fit for all zone axes at once, from the correlogram peak and
+        # its two neighbors
+        inds = np.mod(ind_phi[..., None] + np.arange(-1, 2), self.orientation_gamma.size)
+        c = np.take_along_axis(corr_full, inds, axis=-1)
+        if corr_full_inv is not None:
+            c[corr_inv] = np.take_along_axis(corr_full_inv, inds, axis=-1)[corr_inv]
+        corr_in_plane_angle = np.zeros(corr_value.shape)
+        sub = np.max(c, axis=-1) > 0
+        c = c[sub]
+        dc = (c[:, 2] - c[:, 0]) / (4 * c[:, 1] - 2 * c[:, 0] - 2 * c[:, 2])
+        corr_in_plane_angle[sub] = self.orientation_gamma[ind_phi[sub]] + dc * dphi
+
+        return corr_value, corr_in_plane_angle, corr_inv
+
     def match_single_pattern(
         self,
         bragg_peaks: PointList,
@@ -1757,6 +2158,7 @@ class Crystal:
             subpixel_tilt (bool):         set to false for faster matching, returning the nearest corr point
             plot_polar (bool):            set to true to plot the polar transform of the diffraction pattern
             plot_corr (bool):             set to true to plot the resulting correlogram
+            plot_corr_3D (bool):          set to true to plot the zone axis correlation on the unit sphere
 
         Returns:
             orientation_output (3x3xN float)    orienation matrix where zone axis is the 3rd column, 3rd dim for multiple matches
@@ -1775,55 +2177,48 @@ class Crystal:
             orientation_output = np.zeros((3, 3, num_matches_return))
             corr_output = np.zeros((num_matches_return))
 
+        # in-plane rotation matrix, with its entries updated for each match
+        m3z = np.eye(3)
+
+        # polar Bragg peak image, reused for each match and between calls in the same thread
+        im_polar = _polar_image_buffer(
+            (np.size(self.orientation_shell_radii), self.orientation_in_plane_steps)
+        )
+
+        # Use all CPUs for the polar image and FFTs on the main thread, but only the calling
+        # thread when run from a worker, where the workers already share the CPUs
+        if threading.current_thread() is threading.main_thread():
+            polar_image_build = _polar_image_build
+            fft_workers = -1
+        else:
+            polar_image_build = _polar_image_build_serial
+            fft_workers = 1
+
         # loop over the number of matches to return
         for match_ind in range(num_matches_return):
             # Convert Bragg peaks to polar coordinates
             qr = np.sqrt(qx ** 2 + qy ** 2)
             qphi = np.arctan2(qy, qx)
 
-            # Calculate polar Bragg peak image
-            im_polar = np.zeros(
-                (
-                    np.size(self.orientation_shell_radii),
-                    self.orientation_in_plane_steps,
-                ),
-                dtype="float",
-            )
-
-            for ind_radial, radius in enumerate(self.orientation_shell_radii):
-                dqr = np.abs(qr - radius)
-                sub = dqr < self.orientation_kernel_size
-
-                if np.any(sub):
-                    im_polar[ind_radial, :] = np.sum(
-                        np.power(radius,self.orientation_radial_power)
-                        * np.power(np.max(intensity[sub, None],0),self.orientation_intensity_power)
-                        * np.maximum(
-                            1
-                            - np.sqrt(
-                                dqr[sub, None] ** 2
-                                + (
-                                    (
-                                        np.mod(
-                                            self.orientation_gamma[None, :]
-                                            - qphi[sub, None]
-                                            + np.pi,
-                                            2 * np.pi,
-                                        )
-                                        - np.pi
-                                    )
-                                    * radius
-                                )
-                                ** 2
-                            )
-                            / self.orientation_kernel_size,
-                            0,
-                        ),
-                        axis=0,
-                    )
+            # Calculate polar Bragg peak image, in parallel over radial shells unless called
+            # from a worker thread
+            im_polar.fill(0)
+            polar_image_build(
+                im_polar,
+                qr,
+                qphi,
+                intensity,
+                self.orientation_shell_radii,
+                self.orientation_gamma,
+                float(self.orientation_kernel_size),
+                float(self.orientation_radial_power),
+                float(self.orientation_intensity_power),
+            )
 
-            # FFT along theta
-            im_polar_fft = np.fft.fft(im_polar)
+            # FFT along theta, keeping only the non-negative frequencies of the real image.
+            # The single precision polar image transforms to complex64, matching the
+            # orientation references, so the correlation stays in single precision.
+            im_polar_fft = sfft.rfft(im_polar, workers=fft_workers)
 
             # # 2D correlation method
             # if corr_2D_method:
@@ -1838,64 +2233,19 @@ class Crystal:
             #     im_polar_sin = im_polar * (1-gamma_cos_shift)
             #     im_polar = im_polar_cos + im_polar_sin * (np.sum(im_polar_cos) / np.sum(im_polar_sin))
 
-            # init
-            dphi = self.orientation_gamma[1] - self.orientation_gamma[0]
-            corr_value = np.zeros(self.orientation_num_zones)
-            corr_in_plane_angle = np.zeros(self.orientation_num_zones)
-
-            # Calculate orientation correlogram
-            corr_full = np.maximum(np.sum(
-                np.real(
-                    np.fft.ifft(self.orientation_ref * im_polar_fft[None, :, :])
-                ),
-                axis=1,
-            ),0)
-            ind_phi = np.argmax(corr_full, axis=1)
-
-            # Calculate orientation correlogram for inverse pattern
+            # Calculate orientation correlogram, and for the inverse pattern if needed
+            corr_full = self._orientation_correlogram(im_polar_fft, workers=fft_workers)
             if inversion_symmetry:
-                corr_full_inv = np.maximum(np.sum(
-                    np.real(
-                        np.fft.ifft(self.orientation_ref * np.conj(im_polar_fft)[None, :, :])
-                    ),
-                    axis=1,
-                ),0)
-                ind_phi_inv = np.argmax(corr_full_inv, axis=1)
-                corr_inv = np.zeros(self.orientation_num_zones, dtype='bool')
+                corr_full_inv = self._orientation_correlogram(
+                    np.conj(im_polar_fft), workers=fft_workers
+                )
+            else:
+                corr_full_inv = None
 
             # Find best match for each zone axis
-            for a0 in range(self.orientation_num_zones):
-                # Correlation score
-                if inversion_symmetry:
-                    if corr_full_inv[a0,ind_phi_inv[a0]] > corr_full[a0,ind_phi[a0]]:
-                        corr_value[a0] = corr_full_inv[a0,ind_phi_inv[a0]]
-                        corr_inv[a0] = True
-                    else:
-                        corr_value[a0] = corr_full[a0,ind_phi[a0]]
-                else:
-                    corr_value[a0] = corr_full[a0,ind_phi[a0]]
-
-                # Subpixel angular fit
-                if inversion_symmetry and corr_inv[a0]:
-                    inds = np.mod(
-                        ind_phi_inv[a0] + np.arange(-1, 2), self.orientation_gamma.size
-                    ).astype("int")
-                    c = corr_full_inv[a0, inds]
-                    if np.max(c) > 0:
-                        dc = (c[2] - c[0]) / (4 * c[1] - 2 * c[0] - 2 * c[2])
-                        corr_in_plane_angle[a0] = (
-                            self.orientation_gamma[ind_phi_inv[a0]] + dc * dphi
-                        )
-                else:
-                    inds = np.mod(
-                        ind_phi[a0] + np.arange(-1, 2), self.orientation_gamma.size
-                    ).astype("int")
-                    c = corr_full[a0, inds]
-                    if np.max(c) > 0:
-                        dc = (c[2] - c[0]) / (4 * c[1] - 2 * c[0] - 2 * c[2])
-                        corr_in_plane_angle[a0] = (
-                            self.orientation_gamma[ind_phi[a0]] + dc * dphi
-                        )
+            corr_value, corr_in_plane_angle, corr_inv = self._orientation_in_plane_fit(
+                corr_full, corr_full_inv
+            )
 
             # If needed, keep correlation values for additional matches
             if multiple_corr_reset and num_matches_return > 1 and match_ind == 0:
@@ -1911,293 +2261,67 @@ class Crystal:
 
                 # Get orientation matrix
                 if subpixel_tilt is False:
-                    orientation_matrix = np.squeeze(
-                        self.orientation_rotation_matrices[ind_best_fit, :, :]
-                    )
+                    orientation_matrix = self.orientation_rotation_matrices[ind_best_fit]
 
                 else:
-
-                    def ind_to_sub(ind):
-                        ind_x = np.floor(0.5 * np.sqrt(8.0 * ind + 1) - 0.5).astype("int")
-                        ind_y = ind - np.floor(ind_x * (ind_x + 1) / 2).astype("int")
-                        return ind_x, ind_y
-
-                    def sub_to_ind(ind_x, ind_y):
-                        return (np.floor(ind_x * (ind_x + 1) / 2) + ind_y).astype("int")
-
-                    # Sub pixel refinement of zone axis orientation
-                    if ind_best_fit == 0:
-                        # Zone axis is (0,0,1)
-                        orientation_matrix = np.squeeze(
-                            self.orientation_rotation_matrices[ind_best_fit, :, :]
+                    # Sub pixel refinement of zone axis orientation, as a weighted sum of the
+                    # rotation matrices of the best fit zone axis and its neighbors along the
+                    # two grid directions, selected from the precomputed neighbor table
+                    category = self.orientation_subpixel_category[ind_best_fit]
+                    neighbors = self.orientation_subpixel_neighbors[ind_best_fit]
+                    dx = 0.0
+                    dy = 0.0
+                    ind_x = ind_best_fit
+                    ind_y = ind_best_fit
+
+                    if category == 1:
+                        # Zone axis is on one of the edges of the zone axis range
+                        c = corr_value[[neighbors[0], ind_best_fit, neighbors[1]]]
+                        dx = (c[2] - c[0]) / (4 * c[1] - 2 * c[0] - 2 * c[2])
+                        ind_x = neighbors[int(dx > 0)]
+
+                    elif category == 2:
+                        # best fit point is not on any of the corners or edges
+                        c = np.array(
+                            [
+                                (corr_value[neighbors[0]] + corr_value[neighbors[1]]) / 2,
+                                corr_value[ind_best_fit],
+                                (corr_value[neighbors[4]] + corr_value[neighbors[5]]) / 2,
+                            ]
                         )
+                        dx = (c[2] - c[0]) / (4 * c[1] - 2 * c[0] - 2 * c[2])
 
-                    elif (
-                        ind_best_fit
-                        == self.orientation_num_zones - self.orientation_zone_axis_steps - 1
-                    ):
-                        # Zone axis is 1st user provided direction
-                        orientation_matrix = np.squeeze(
-                            self.orientation_rotation_matrices[ind_best_fit, :, :]
-                        )
+                        c = corr_value[[neighbors[2], ind_best_fit, neighbors[3]]]
+                        dy = (c[2] - c[0]) / (4 * c[1] - 2 * c[0] - 2 * c[2])
 
-                    elif ind_best_fit == self.orientation_num_zones - 1:
-                        # Zone axis is the 2nd user-provided direction
-                        orientation_matrix = np.squeeze(
-                            self.orientation_rotation_matrices[ind_best_fit, :, :]
-                        )
+                        ind_x = neighbors[(0, 1, 4, 5)[2 * int(dx > 0) + int(dy > 0)]]
+                        ind_y = neighbors[2 + int(dy > 0)]
 
-                    else:
-                        ind_x, ind_y = ind_to_sub(ind_best_fit)
-                        max_x, max_y = ind_to_sub(self.orientation_num_zones - 1)
-
-                        if ind_y == 0:
-                            ind_x_prev = sub_to_ind(ind_x - 1, 0)
-                            ind_x_post = sub_to_ind(ind_x + 1, 0)
-
-                            c = np.array(
-                                [
-                                    corr_value[ind_x_prev],
-                                    corr_value[ind_best_fit],
-                                    corr_value[ind_x_post],
-                                ]
-                            )
-                            dc = (c[2] - c[0]) / (4 * c[1] - 2 * c[0] - 2 * c[2])
-
-                            if dc > 0:
-                                orientation_matrix = (
-                                    np.squeeze(
-                                        self.orientation_rotation_matrices[
-                                            ind_best_fit, :, :
-                                        ]
-                                    )
-                                    * (1 - dc)
-                                    + np.squeeze(
-                                        self.orientation_rotation_matrices[ind_x_post, :, :]
-                                    )
-                                    * dc
-                                )
-                            else:
-                                orientation_matrix = (
-                                    np.squeeze(
-                                        self.orientation_rotation_matrices[
-                                            ind_best_fit, :, :
-                                        ]
-                                    )
-                                    * (1 + dc)
-                                    + np.squeeze(
-                                        self.orientation_rotation_matrices[ind_x_prev, :, :]
-                                    )
-                                    * -dc
-                                )
-
-                        elif ind_x == max_x:
-                            ind_x_prev = sub_to_ind(max_x, ind_y - 1)
-                            ind_x_post = sub_to_ind(max_x, ind_y + 1)
-
-                            c = np.array(
-                                [
-                                    corr_value[ind_x_prev],
-                                    corr_value[ind_best_fit],
-                                    corr_value[ind_x_post],
-                                ]
-                            )
-                            dc = (c[2] - c[0]) / (4 * c[1] - 2 * c[0] - 2 * c[2])
-
-                            if dc > 0:
-                                orientation_matrix = (
-                                    np.squeeze(
-                                        self.orientation_rotation_matrices[
-                                            ind_best_fit, :, :
-                                        ]
-                                    )
-                                    * (1 - dc)
-                                    + np.squeeze(
-                                        self.orientation_rotation_matrices[ind_x_post, :, :]
-                                    )
-                                    * dc
-                                )
-                            else:
-                                orientation_matrix = (
-                                    np.squeeze(
-                                        self.orientation_rotation_matrices[
-                                            ind_best_fit, :, :
-                                        ]
-                                    )
-                                    * (1 + dc)
-                                    + np.squeeze(
-                                        self.orientation_rotation_matrices[ind_x_prev, :, :]
-                                    )
-                                    * -dc
-                                )
-
-                        elif ind_x == ind_y:
-                            ind_x_prev = sub_to_ind(ind_x - 1, ind_y - 1)
-                            ind_x_post = sub_to_ind(ind_x + 1, ind_y + 1)
-
-                            c = np.array(
-                                [
-                                    corr_value[ind_x_prev],
-                                    corr_value[ind_best_fit],
-                                    corr_value[ind_x_post],
-                                ]
-                            )
-                            dc = (c[2] - c[0]) / (4 * c[1] - 2 * c[0] - 2 * c[2])
-
-                            if dc > 0:
-                                orientation_matrix = (
-                                    np.squeeze(
-                                        self.orientation_rotation_matrices[
-                                            ind_best_fit, :, :
-                                        ]
-                                    )
-                                    * (1 - dc)
-                                    + np.squeeze(
-                                        self.orientation_rotation_matrices[ind_x_post, :, :]
-                                    )
-                                    * dc
-                                )
-                            else:
-                                orientation_matrix = (
-                                    np.squeeze(
-                                        self.orientation_rotation_matrices[
-                                            ind_best_fit, :, :
-                                        ]
-                                    )
-                                    * (1 + dc)
-                                    + np.squeeze(
-                                        self.orientation_rotation_matrices[ind_x_prev, :, :]
-                                    )
-                                    * -dc
-                                )
-
-                        else:
-                            # # best fit point is not on any of the corners or edges
-                            ind_1 = sub_to_ind(ind_x - 1, ind_y - 1)
-                            ind_2 = sub_to_ind(ind_x - 1, ind_y)
-                            ind_3 = sub_to_ind(ind_x, ind_y - 1)
-                            ind_4 = sub_to_ind(ind_x, ind_y + 1)
-                            ind_5 = sub_to_ind(ind_x + 1, ind_y)
-                            ind_6 = sub_to_ind(ind_x + 1, ind_y + 1)
-
-                            c = np.array(
-                                [
-                                    (corr_value[ind_1] + corr_value[ind_2]) / 2,
-                                    corr_value[ind_best_fit],
-                                    (corr_value[ind_5] + corr_value[ind_6]) / 2,
-                                ]
-                            )
-                            dx = (c[2] - c[0]) / (4 * c[1] - 2 * c[0] - 2 * c[2])
-
-                            c = np.array(
-                                [
-                                    corr_value[ind_3],
-                                    corr_value[ind_best_fit],
-                                    corr_value[ind_4],
-                                ]
-                            )
-                            dy = (c[2] - c[0]) / (4 * c[1] - 2 * c[0] - 2 * c[2])
-
-                            if dx > 0:
-                                if dy > 0:
-                                    orientation_matrix = (
-                                        np.squeeze(
-                                            self.orientation_rotation_matrices[
-                                                ind_best_fit, :, :
-                                            ]
-                                        )
-                                        * (1 - dx)
-                                        * (1 - dy)
-                                        + np.squeeze(
-                                            self.orientation_rotation_matrices[ind_4, :, :]
-                                        )
-                                        * (1 - dx)
-                                        * (dy)
-                                        + np.squeeze(
-                                            self.orientation_rotation_matrices[ind_6, :, :]
-                                        )
-                                        * dx
-                                    )
-                                else:
-                                    orientation_matrix = (
-                                        np.squeeze(
-                                            self.orientation_rotation_matrices[
-                                                ind_best_fit, :, :
-                                            ]
-                                        )
-                                        * (1 - dx)
-                                        * (1 + dy)
-                                        + np.squeeze(
-                                            self.orientation_rotation_matrices[ind_3, :, :]
-                                        )
-                                        * (1 - dx)
-                                        * (-dy)
-                                        + np.squeeze(
-                                            self.orientation_rotation_matrices[ind_5, :, :]
-                                        )
-                                        * dx
-                                    )
-                            else:
-                                if dy > 0:
-                                    orientation_matrix = (
-                                        np.squeeze(
-                                            self.orientation_rotation_matrices[
-                                                ind_best_fit, :, :
-                                            ]
-                                        )
-                                        * (1 + dx)
-                                        * (1 - dy)
-                                        + np.squeeze(
-                                            self.orientation_rotation_matrices[ind_4, :, :]
-                                        )
-                                        * (1 + dx)
-                                        * (dy)
-                                        + np.squeeze(
-                                            self.orientation_rotation_matrices[ind_2, :, :]
-                                        )
-                                        * -dx
-                                    )
-                                else:
-                                    orientation_matrix = (
-                                        np.squeeze(
-                                            self.orientation_rotation_matrices[
-                                                ind_best_fit, :, :
-                                            ]
-                                        )
-                                        * (1 + dx)
-                                        * (1 + dy)
-                                        + np.squeeze(
-                                            self.orientation_rotation_matrices[ind_3, :, :]
-                                        )
-                                        * (1 + dx)
-                                        * (-dy)
-                                        + np.squeeze(
-                                            self.orientation_rotation_matrices[ind_1, :, :]
-                                        )
-                                        * -dx
-                                    )
+                    weights = np.array(
+                        [
+                            (1 - abs(dx)) * (1 - abs(dy)),
+                            (1 - abs(dx)) * abs(dy),
+                            abs(dx),
+                        ]
+                    )
+                    orientation_matrix = np.tensordot(
+                        weights,
+                        self.orientation_rotation_matrices[[ind_best_fit, ind_y, ind_x]],
+                        axes=1,
+                    )
 
                 # apply in-plane rotation, and inversion if needed
                 if multiple_corr_reset and match_ind > 0:
                     phi = corr_in_plane_angle_keep[ind_best_fit]                     
                 else:
                     phi = corr_in_plane_angle[ind_best_fit] 
-                if inversion_symmetry and corr_inv[ind_best_fit]:
-                    m3z = np.array(
-                        [
-                            [np.cos(phi), np.sin(phi), 0],
-                            [-np.sin(phi), np.cos(phi), 0],
-                            [0, 0, -1],
-                        ]
-                    )
-                else:
-                    m3z = np.array(
-                        [
-                            [np.cos(phi), np.sin(phi), 0],
-                            [-np.sin(phi), np.cos(phi), 0],
-                            [0, 0, 1],
-                        ]
-                    )
+                cos_phi = np.cos(phi)
+                sin_phi = np.sin(phi)
+                m3z[0, 0] = cos_phi
+                m3z[0, 1] = sin_phi
+                m3z[1, 0] = -sin_phi
+                m3z[1, 1] = cos_phi
+                m3z[2, 2] = -1 if inversion_symmetry and corr_inv[ind_best_fit] else 1
                 orientation_matrix = orientation_matrix @ m3z
                 # if inversion_symmetry and corr_inv[ind_best_fit]:
                 #     orientation_matrix = np.linalg.inv(np.linalg.inv(orientation_matrix) 
@@ -2220,9 +2344,7 @@ class Crystal:
 
             else:
                 # No more matches are detector, so output default orienation matrix and corr = 0
-                orientation_matrix = np.squeeze(
-                        self.orientation_rotation_matrices[0, :, :]
-                    )
+                orientation_matrix = self.orientation_rotation_matrices[0]
                 if multiple_corr_reset and match_ind > 0:
                     corr_value_keep[ind_best_fit] = 0;
 
@@ -2277,21 +2399,17 @@ class Crystal:
                     sigma_excitation_error=self.orientation_kernel_size,
                 )
 
-                remove = np.zeros_like(qx, dtype="bool")
+                # Distance from each measured peak to the nearest fitted peak
+                dist_min = cKDTree(
+                    np.vstack((bragg_peaks_fit.data["qx"], bragg_peaks_fit.data["qy"])).T
+                ).query(np.vstack((qx, qy)).T)[0]
+
+                remove = dist_min < self.orientation_tol_peak_delete
                 scale_int = np.zeros_like(qx)
-                for a0 in np.arange(qx.size):
-                    d_2 = (bragg_peaks_fit.data["qx"] - qx[a0]) ** 2 + (
-                        bragg_peaks_fit.data["qy"] - qy[a0]
-                    ) ** 2
-
-                    dist_min = np.sqrt(np.min(d_2))
-
-                    if dist_min < self.orientation_tol_peak_delete:
-                        remove[a0] = True
-                    elif dist_min < self.orientation_kernel_size:
-                        scale_int[a0] = (dist_min - self.orientation_tol_peak_delete) / (
-                            self.orientation_kernel_size - self.orientation_tol_peak_delete
-                        )
+                sub = np.logical_and(~remove, dist_min < self.orientation_kernel_size)
+                scale_int[sub] = (dist_min[sub] - self.orientation_tol_peak_delete) / (
+                    self.orientation_kernel_size - self.orientation_tol_peak_delete
+                )
 
                 intensity = intensity * scale_int
                 qx = qx[~remove]
@@ -2308,263 +2426,318 @@ class Crystal:
 
         # plotting correlation image
         if plot_corr is True:
+            plot_output = self.plot_orientation_correlation(
+                corr_value,
+                corr_full,
+                ind_best_fit,
+                figsize=figsize,
+                returnfig=returnfig,
+            )
+            if returnfig:
+                fig, ax = plot_output
 
-            if self.orientation_full:
-                fig, ax = plt.subplots(1, 2, figsize=figsize * np.array([2, 2]))
-                cmin = np.min(corr_value)
-                cmax = np.max(corr_value)
+        if plot_corr_3D is True:
+            plot_output = self.plot_orientation_correlation_3D(
+                corr_full,
+                figsize=figsize,
+                returnfig=returnfig,
+            )
+            if returnfig:
+                fig, ax = plot_output
 
-                im_corr_zone_axis = np.zeros(
-                    (
-                        2 * self.orientation_zone_axis_steps + 1,
-                        2 * self.orientation_zone_axis_steps + 1,
-                    )
-                )
+        if return_corr:
+            if returnfig:
+                return orientation_output, corr_output, fig, ax
+            else:
+                return orientation_output, corr_output
+        else:
+            if returnfig:
+                return orientation_output, fig, ax
+            else:
+                return orientation_output
 
-                sub = self.orientation_inds[:, 2] == 0
-                x_inds = (
-                    self.orientation_inds[sub, 0] - self.orientation_inds[sub, 1]
-                ).astype("int") + self.orientation_zone_axis_steps
-                y_inds = (
-                    self.orientation_inds[sub, 1].astype("int")
-                    + self.orientation_zone_axis_steps
-                )
-                inds_1D = np.ravel_multi_index(
-                    [x_inds, y_inds], im_corr_zone_axis.shape
-                )
-                im_corr_zone_axis.ravel()[inds_1D] = corr_value[sub]
-
-                sub = self.orientation_inds[:, 2] == 1
-                x_inds = (
-                    self.orientation_inds[sub, 0] - self.orientation_inds[sub, 1]
-                ).astype("int") + self.orientation_zone_axis_steps
-                y_inds = self.orientation_zone_axis_steps - self.orientation_inds[
-                    sub, 1
-                ].astype("int")
-                inds_1D = np.ravel_multi_index(
-                    [x_inds, y_inds], im_corr_zone_axis.shape
-                )
-                im_corr_zone_axis.ravel()[inds_1D] = corr_value[sub]
-
-                sub = self.orientation_inds[:, 2] == 2
-                x_inds = (
-                    self.orientation_inds[sub, 1] - self.orientation_inds[sub, 0]
-                ).astype("int") + self.orientation_zone_axis_steps
-                y_inds = (
-                    self.orientation_inds[sub, 1].astype("int")
-                    + self.orientation_zone_axis_steps
-                )
-                inds_1D = np.ravel_multi_index(
-                    [x_inds, y_inds], im_corr_zone_axis.shape
-                )
-                im_corr_zone_axis.ravel()[inds_1D] = corr_value[sub]
-
-                sub = self.orientation_inds[:, 2] == 3
-                x_inds = (
-                    self.orientation_inds[sub, 1] - self.orientation_inds[sub, 0]
-                ).astype("int") + self.orientation_zone_axis_steps
-                y_inds = self.orientation_zone_axis_steps - self.orientation_inds[
-                    sub, 1
-                ].astype("int")
-                inds_1D = np.ravel_multi_index(
-                    [x_inds, y_inds], im_corr_zone_axis.shape
+    def plot_orientation_correlation(
+        self,
+        corr_value: np.ndarray,
+        corr_full: np.ndarray,
+        ind_best_fit: int,
+        figsize: Union[list, tuple, np.ndarray] = (12, 4),
+        returnfig: bool = False,
+    ):
+        """
+        Plot the zone axis correlogram of a single diffraction pattern, and the in-plane
+        rotation correlation of its best fit zone axis.
+
+        Args:
+            corr_value (np.array):      correlation score of each zone axis
+            corr_full (np.array):       correlogram, with shape (num_zones, in_plane_steps)
+            ind_best_fit (int):         index of the best fit zone axis
+            figsize (float):            (2,) vector giving the figure size
+            returnfig (bool):           set to True to return figure and axes handles
+        """
+        if self.orientation_full:
+            fig, ax = plt.subplots(1, 2, figsize=figsize * np.array([2, 2]))
+            cmin = np.min(corr_value)
+            cmax = np.max(corr_value)
+
+            im_corr_zone_axis = np.zeros(
+                (
+                    2 * self.orientation_zone_axis_steps + 1,
+                    2 * self.orientation_zone_axis_steps + 1,
                 )
-                im_corr_zone_axis.ravel()[inds_1D] = corr_value[sub]
+            )
 
-                im_plot = (im_corr_zone_axis - cmin) / (cmax - cmin)
-                ax[0].imshow(im_plot, cmap="viridis", vmin=0.0, vmax=1.0)
+            sub = self.orientation_inds[:, 2] == 0
+            x_inds = (
+                self.orientation_inds[sub, 0] - self.orientation_inds[sub, 1]
+            ).astype("int") + self.orientation_zone_axis_steps
+            y_inds = (
+                self.orientation_inds[sub, 1].astype("int")
+                + self.orientation_zone_axis_steps
+            )
+            inds_1D = np.ravel_multi_index(
+                [x_inds, y_inds], im_corr_zone_axis.shape
+            )
+            im_corr_zone_axis.ravel()[inds_1D] = corr_value[sub]
+
+            sub = self.orientation_inds[:, 2] == 1
+            x_inds = (
+                self.orientation_inds[sub, 0] - self.orientation_inds[sub, 1]
+            ).astype("int") + self.orientation_zone_axis_steps
+            y_inds = self.orientation_zone_axis_steps - self.orientation_inds[
+                sub, 1
+            ].astype("int")
+            inds_1D = np.ravel_multi_index(
+                [x_inds, y_inds], im_corr_zone_axis.shape
+            )
+            im_corr_zone_axis.ravel()[inds_1D] = corr_value[sub]
+
+            sub = self.orientation_inds[:, 2] == 2
+            x_inds = (
+                self.orientation_inds[sub, 1] - self.orientation_inds[sub, 0]
+            ).astype("int") + self.orientation_zone_axis_steps
+            y_inds = (
+                self.orientation_inds[sub, 1].astype("int")
+                + self.orientation_zone_axis_steps
+            )
+            inds_1D = np.ravel_multi_index(
+                [x_inds, y_inds], im_corr_zone_axis.shape
+            )
+            im_corr_zone_axis.ravel()[inds_1D] = corr_value[sub]
+
+            sub = self.orientation_inds[:, 2] == 3
+            x_inds = (
+                self.orientation_inds[sub, 1] - self.orientation_inds[sub, 0]
+            ).astype("int") + self.orientation_zone_axis_steps
+            y_inds = self.orientation_zone_axis_steps - self.orientation_inds[
+                sub, 1
+            ].astype("int")
+            inds_1D = np.ravel_multi_index(
+                [x_inds, y_inds], im_corr_zone_axis.shape
+            )
+            im_corr_zone_axis.ravel()[inds_1D] = corr_value[sub]
 
-            elif self.orientation_half:
-                fig, ax = plt.subplots(1, 2, figsize=figsize * np.array([2, 1]))
-                cmin = np.min(corr_value)
-                cmax = np.max(corr_value)
+            im_plot = (im_corr_zone_axis - cmin) / (cmax - cmin)
+            ax[0].imshow(im_plot, cmap="viridis", vmin=0.0, vmax=1.0)
 
-                im_corr_zone_axis = np.zeros(
-                    (
-                        self.orientation_zone_axis_steps + 1,
-                        self.orientation_zone_axis_steps * 2 + 1,
-                    )
-                )
+        elif self.orientation_half:
+            fig, ax = plt.subplots(1, 2, figsize=figsize * np.array([2, 1]))
+            cmin = np.min(corr_value)
+            cmax = np.max(corr_value)
 
-                sub = self.orientation_inds[:, 2] == 0
-                x_inds = (
-                    self.orientation_inds[sub, 0] - self.orientation_inds[sub, 1]
-                ).astype("int")
-                y_inds = (
-                    self.orientation_inds[sub, 1].astype("int")
-                    + self.orientation_zone_axis_steps
-                )
-                inds_1D = np.ravel_multi_index(
-                    [x_inds, y_inds], im_corr_zone_axis.shape
-                )
-                im_corr_zone_axis.ravel()[inds_1D] = corr_value[sub]
-
-                sub = self.orientation_inds[:, 2] == 1
-                x_inds = (
-                    self.orientation_inds[sub, 0] - self.orientation_inds[sub, 1]
-                ).astype("int")
-                y_inds = self.orientation_zone_axis_steps - self.orientation_inds[
-                    sub, 1
-                ].astype("int")
-                inds_1D = np.ravel_multi_index(
-                    [x_inds, y_inds], im_corr_zone_axis.shape
+            im_corr_zone_axis = np.zeros(
+                (
+                    self.orientation_zone_axis_steps + 1,
+                    self.orientation_zone_axis_steps * 2 + 1,
                 )
-                im_corr_zone_axis.ravel()[inds_1D] = corr_value[sub]
+            )
 
-                im_plot = (im_corr_zone_axis - cmin) / (cmax - cmin)
-                ax[0].imshow(im_plot, cmap="viridis", vmin=0.0, vmax=1.0)
+            sub = self.orientation_inds[:, 2] == 0
+            x_inds = (
+                self.orientation_inds[sub, 0] - self.orientation_inds[sub, 1]
+            ).astype("int")
+            y_inds = (
+                self.orientation_inds[sub, 1].astype("int")
+                + self.orientation_zone_axis_steps
+            )
+            inds_1D = np.ravel_multi_index(
+                [x_inds, y_inds], im_corr_zone_axis.shape
+            )
+            im_corr_zone_axis.ravel()[inds_1D] = corr_value[sub]
 
-            else:
-                fig, ax = plt.subplots(1, 2, figsize=figsize)
-                cmin = np.min(corr_value)
-                cmax = np.max(corr_value)
+            sub = self.orientation_inds[:, 2] == 1
+            x_inds = (
+                self.orientation_inds[sub, 0] - self.orientation_inds[sub, 1]
+            ).astype("int")
+            y_inds = self.orientation_zone_axis_steps - self.orientation_inds[
+                sub, 1
+            ].astype("int")
+            inds_1D = np.ravel_multi_index(
+                [x_inds, y_inds], im_corr_zone_axis.shape
+            )
+            im_corr_zone_axis.ravel()[inds_1D] = corr_value[sub]
 
-                im_corr_zone_axis = np.zeros(
-                    (
-                        self.orientation_zone_axis_steps + 1,
-                        self.orientation_zone_axis_steps + 1,
-                    )
-                )
-                im_mask = np.ones(
-                    (
-                        self.orientation_zone_axis_steps + 1,
-                        self.orientation_zone_axis_steps + 1,
-                    ),
-                    dtype="bool",
-                )
+            im_plot = (im_corr_zone_axis - cmin) / (cmax - cmin)
+            ax[0].imshow(im_plot, cmap="viridis", vmin=0.0, vmax=1.0)
 
-                x_inds = (
-                    self.orientation_inds[:, 0] - self.orientation_inds[:, 1]
-                ).astype("int")
-                y_inds = self.orientation_inds[:, 1].astype("int")
-                inds_1D = np.ravel_multi_index(
-                    [x_inds, y_inds], im_corr_zone_axis.shape
-                )
-                im_corr_zone_axis.ravel()[inds_1D] = corr_value
-                im_mask.ravel()[inds_1D] = False
+        else:
+            fig, ax = plt.subplots(1, 2, figsize=figsize)
+            cmin = np.min(corr_value)
+            cmax = np.max(corr_value)
 
-                im_plot = np.ma.masked_array(
-                    (im_corr_zone_axis - cmin) / (cmax - cmin), mask=im_mask
+            im_corr_zone_axis = np.zeros(
+                (
+                    self.orientation_zone_axis_steps + 1,
+                    self.orientation_zone_axis_steps + 1,
                 )
+            )
+            im_mask = np.ones(
+                (
+                    self.orientation_zone_axis_steps + 1,
+                    self.orientation_zone_axis_steps + 1,
+                ),
+                dtype="bool",
+            )
 
-                ax[0].imshow(im_plot, cmap="viridis", vmin=0.0, vmax=1.0)
-                ax[0].spines["left"].set_color("none")
-                ax[0].spines["right"].set_color("none")
-                ax[0].spines["top"].set_color("none")
-                ax[0].spines["bottom"].set_color("none")
+            x_inds = (
+                self.orientation_inds[:, 0] - self.orientation_inds[:, 1]
+            ).astype("int")
+            y_inds = self.orientation_inds[:, 1].astype("int")
+            inds_1D = np.ravel_multi_index(
+                [x_inds, y_inds], im_corr_zone_axis.shape
+            )
+            im_corr_zone_axis.ravel()[inds_1D] = corr_value
+            im_mask.ravel()[inds_1D] = False
 
-                inds_plot = np.unravel_index(
-                    np.argmax(im_plot, axis=None), im_plot.shape
-                )
-                ax[0].scatter(
-                    inds_plot[1],
-                    inds_plot[0],
-                    s=120,
-                    linewidth=2,
-                    facecolors="none",
-                    edgecolors="r",
-                )
+            im_plot = np.ma.masked_array(
+                (im_corr_zone_axis - cmin) / (cmax - cmin), mask=im_mask
+            )
 
-                label_0 = self.orientation_zone_axis_range[0, :]
-                label_0 = np.round(label_0 * 1e3) * 1e-3
-                label_0 = label_0 / np.min(np.abs(label_0[np.abs(label_0) > 0]))
+            ax[0].imshow(im_plot, cmap="viridis", vmin=0.0, vmax=1.0)
+            ax[0].spines["left"].set_color("none")
+            ax[0].spines["right"].set_color("none")
+            ax[0].spines["top"].set_color("none")
+            ax[0].spines["bottom"].set_color("none")
 
-                label_1 = self.orientation_zone_axis_range[1, :]
-                label_1 = np.round(label_1 * 1e3) * 1e-3
-                label_1 = label_1 / np.min(np.abs(label_1[np.abs(label_1) > 0]))
+            inds_plot = np.unravel_index(
+                np.argmax(im_plot, axis=None), im_plot.shape
+            )
+            ax[0].scatter(
+                inds_plot[1],
+                inds_plot[0],
+                s=120,
+                linewidth=2,
+                facecolors="none",
+                edgecolors="r",
+            )
 
-                label_2 = self.orientation_zone_axis_range[2, :]
-                label_2 = np.round(label_2 * 1e3) * 1e-3
-                label_2 = label_2 / np.min(np.abs(label_2[np.abs(label_2) > 0]))
+            label_0 = self.orientation_zone_axis_range[0, :]
+            label_0 = np.round(label_0 * 1e3) * 1e-3
+            label_0 = label_0 / np.min(np.abs(label_0[np.abs(label_0) > 0]))
 
-                ax[0].set_xticks([0, self.orientation_zone_axis_steps])
-                ax[0].set_xticklabels([str(label_0), str(label_2)], size=14)
-                ax[0].xaxis.tick_top()
+            label_1 = self.orientation_zone_axis_range[1, :]
+            label_1 = np.round(label_1 * 1e3) * 1e-3
+            label_1 = label_1 / np.min(np.abs(label_1[np.abs(label_1) > 0]))
 
-                ax[0].set_yticks([self.orientation_zone_axis_steps])
-                ax[0].set_yticklabels([str(label_1)], size=14)
+            label_2 = self.orientation_zone_axis_range[2, :]
+            label_2 = np.round(label_2 * 1e3) * 1e-3
+            label_2 = label_2 / np.min(np.abs(label_2[np.abs(label_2) > 0]))
 
-            # In-plane rotation
-            # ax[1].plot(
-            #     self.orientation_gamma * 180 / np.pi,
-            #     (np.squeeze(corr_full[ind_best_fit, :]) - cmin) / (cmax - cmin),
-            # )
-            sig_in_plane = np.squeeze(corr_full[ind_best_fit, :])
-            ax[1].plot(
-                self.orientation_gamma * 180 / np.pi,
-                sig_in_plane / np.max(sig_in_plane),
-            )
-            ax[1].set_xlabel("In-plane rotation angle [deg]", size=16)
-            ax[1].set_ylabel("Corr. of Best Fit Zone Axis", size=16)
-            ax[1].set_ylim([0, 1.01])
+            ax[0].set_xticks([0, self.orientation_zone_axis_steps])
+            ax[0].set_xticklabels([str(label_0), str(label_2)], size=14)
+            ax[0].xaxis.tick_top()
+
+            ax[0].set_yticks([self.orientation_zone_axis_steps])
+            ax[0].set_yticklabels([str(label_1)], size=14)
+
+        # In-plane rotation
+        # ax[1].plot(
+        #     self.orientation_gamma * 180 / np.pi,
+        #     (np.squeeze(corr_full[ind_best_fit, :]) - cmin) / (cmax - cmin),
+        # )
+        sig_in_plane = corr_full[ind_best_fit]
+        ax[1].plot(
+            self.orientation_gamma * 180 / np.pi,
+            sig_in_plane / np.max(sig_in_plane),
+        )
+        ax[1].set_xlabel("In-plane rotation angle [deg]", size=16)
+        ax[1].set_ylabel("Corr. of Best Fit Zone Axis", size=16)
+        ax[1].set_ylim([0, 1.01])
 
+        if returnfig:
+            return fig, ax
+        else:
             plt.show()
 
-        if plot_corr_3D is True:
-            # 3D plotting
-
-            fig = plt.figure(figsize=[figsize[0], figsize[0]])
-            ax = fig.add_subplot(projection="3d", elev=90, azim=0)
+    def plot_orientation_correlation_3D(
+        self,
+        corr_full: np.ndarray,
+        figsize: Union[list, tuple, np.ndarray] = (12, 4),
+        returnfig: bool = False,
+    ):
+        """
+        Plot the maximum correlation of each zone axis of a single diffraction pattern on
+        the unit sphere.
 
-            sig_zone_axis = np.max(corr, axis=1)
+        Args:
+            corr_full (np.array):       correlogram, with shape (num_zones, in_plane_steps)
+            figsize (float):            (2,) vector giving the figure size
+            returnfig (bool):           set to True to return figure and axes handles
+        """
+        fig = plt.figure(figsize=[figsize[0], figsize[0]])
+        ax = fig.add_subplot(projection="3d", elev=90, azim=0)
 
-            el = self.orientation_rotation_angles[:, 0, 0]
-            az = self.orientation_rotation_angles[:, 0, 1]
-            x = np.cos(az) * np.sin(el)
-            y = np.sin(az) * np.sin(el)
-            z = np.cos(el)
+        sig_zone_axis = np.max(corr_full, axis=1)
 
-            v = np.vstack((x.ravel(), y.ravel(), z.ravel()))
+        el = self.orientation_rotation_angles[:, 1]
+        az = self.orientation_rotation_angles[:, 0]
+        x = np.cos(az) * np.sin(el)
+        y = np.sin(az) * np.sin(el)
+        z = np.cos(el)
 
-            v_order = np.array(
-                [
-                    [0, 1, 2],
-                    [0, 2, 1],
-                    [1, 0, 2],
-                    [1, 2, 0],
-                    [2, 0, 1],
-                    [2, 1, 0],
-                ]
-            )
-            d_sign = np.array(
-                [
-                    [1, 1, 1],
-                    [-1, 1, 1],
-                    [1, -1, 1],
-                    [-1, -1, 1],
-                ]
-            )
+        v = np.vstack((x.ravel(), y.ravel(), z.ravel()))
 
-            for a1 in range(d_sign.shape[0]):
-                for a0 in range(v_order.shape[0]):
-                    ax.scatter(
-                        xs=v[v_order[a0, 0]] * d_sign[a1, 0],
-                        ys=v[v_order[a0, 1]] * d_sign[a1, 1],
-                        zs=v[v_order[a0, 2]] * d_sign[a1, 2],
-                        s=30,
-                        c=sig_zone_axis.ravel(),
-                        edgecolors=None,
-                    )
+        v_order = np.array(
+            [
+                [0, 1, 2],
+                [0, 2, 1],
+                [1, 0, 2],
+                [1, 2, 0],
+                [2, 0, 1],
+                [2, 1, 0],
+            ]
+        )
+        d_sign = np.array(
+            [
+                [1, 1, 1],
+                [-1, 1, 1],
+                [1, -1, 1],
+                [-1, -1, 1],
+            ]
+        )
 
-            # axes limits
-            r = 1.05
-            ax.axes.set_xlim3d(left=-r, right=r)
-            ax.axes.set_ylim3d(bottom=-r, top=r)
-            ax.axes.set_zlim3d(bottom=-r, top=r)
-            axisEqual3D(ax)
+        for a1 in range(d_sign.shape[0]):
+            for a0 in range(v_order.shape[0]):
+                ax.scatter(
+                    xs=v[v_order[a0, 0]] * d_sign[a1, 0],
+                    ys=v[v_order[a0, 1]] * d_sign[a1, 1],
+                    zs=v[v_order[a0, 2]] * d_sign[a1, 2],
+                    s=30,
+                    c=sig_zone_axis.ravel(),
+                    edgecolors=None,
+                )
 
-            plt.show()
+        # axes limits
+        r = 1.05
+        ax.axes.set_xlim3d(left=-r, right=r)
+        ax.axes.set_ylim3d(bottom=-r, top=r)
+        ax.axes.set_zlim3d(bottom=-r, top=r)
+        axisEqual3D(ax)
 
-        if return_corr:
-            if returnfig:
-                return orientation_output, corr_output, fig, ax
-            else:
-                return orientation_output, corr_output
+        if returnfig:
+            return fig, ax
         else:
-            if returnfig:
-                return orientation_output, fig, ax
-            else:
-                return orientation_output
+            plt.show()
 
     def generate_diffraction_pattern(
         self,
@@ -2591,11 +2764,132 @@ class Crystal:
             bragg_peaks (PointList):         list of all Bragg peaks with fields [qx, qy, intensity, h, k, l]
         """
 
+        # Wavevector, foil normal and projection basis
+        k0, foil_normal, k_proj = self._diffraction_pattern_geometry(
+            zone_axis, foil_normal, proj_x_axis
+        )
+
+        # Threshold for inclusion in diffraction pattern
+        sg_max = sigma_excitation_error * tol_excitation_error_mult
+
+        # Excitation errors and diffracted peak intensities in a single pass over the g vectors.
+        # The kernel streams each row of the (3, N) g vector array, so keep the rows contiguous.
+        # Intensities are stored in single precision like the structure factor intensities.
+        # Only the main thread launches the parallel kernel, see match_orientations.
+        g_int = np.empty(self.g_vec_leng.size, dtype="float32")
+        keep_int = np.empty(self.g_vec_leng.size, dtype=np.bool_)
+        if threading.current_thread() is threading.main_thread():
+            excitation_error_intensity = _excitation_error_intensity
+        else:
+            excitation_error_intensity = _excitation_error_intensity_serial
+        excitation_error_intensity(
+            g_int,
+            keep_int,
+            np.ascontiguousarray(self.g_vec_all),
+            self.struct_factors_int,
+            k0,
+            foil_normal,
+            sg_max,
+            sigma_excitation_error,
+            tol_intensity,
+        )
+        keep = np.nonzero(keep_int)[0]
+
+        return self._diffraction_pattern_pointlist(k_proj, keep, g_int[keep])
+
+    def generate_diffraction_patterns(
+        self,
+        zone_axes: np.ndarray,
+        foil_normal: Optional[Union[list, tuple, np.ndarray]] = None,
+        proj_x_axis: Optional[Union[list, tuple, np.ndarray]] = None,
+        sigma_excitation_error: float = 0.02,
+        tol_excitation_error_mult: float = 3,
+        tol_intensity: float = 0.1,
+        batch_size: int = 16,
+    ):
+        """
+        Generate diffraction patterns for a stack of zone axes, return a list of pointlists.
+        The excitation errors of each batch of zone axes are evaluated for all g vectors at
+        once with matrix products, rather than one pattern at a time.
+
+        Args:
+            zone_axes (np float array):     (M,3) array of projection directions, or (M,3,3)
+                                             array of orientation matrices (zone axis 3rd column)
+            foil_normal:                     3 element foil normal shared by all patterns - set
+                                             to None to use each zone axis
+            proj_x_axis (np float vector):   3 element vector defining image x axis (vertical)
+            sigma_excitation_error (float): sigma value for envelope applied to s_g (excitation errors) in units of inverse Angstroms
+            tol_excitation_error_mult (float): tolerance in units of sigma for s_g inclusion
+            tol_intensity (np float):        tolerance in intensity units for inclusion of diffraction spots
+            batch_size (int):                number of zone axes evaluated together
+
+        Returns:
+            bragg_peaks (list):              list of M PointLists with fields [qx, qy, intensity, h, k, l]
+        """
+
+        # Wavevectors, foil normals and projection bases of all patterns
+        geometry = [
+            self._diffraction_pattern_geometry(zone_axis, foil_normal, proj_x_axis)
+            for zone_axis in np.asarray(zone_axes, dtype="float")
+        ]
+
+        # Threshold for inclusion in diffraction patterns
+        sg_max = sigma_excitation_error * tol_excitation_error_mult
+
+        # Only structure factors above the intensity tolerance can be kept, since the
+        # excitation error envelope is at most 1
+        inds_g = np.nonzero(self.struct_factors_int > tol_intensity)[0]
+        g_vec = np.ascontiguousarray(self.g_vec_all[:, inds_g])
+        g_half_sq = 0.5 * self.g_vec_leng[inds_g] ** 2
+        struct_factors_int = self.struct_factors_int[inds_g]
+
+        bragg_peaks = []
+        for a0 in range(0, len(geometry), batch_size):
+            k0 = np.array([geom[0] for geom in geometry[a0 : a0 + batch_size]])
+            normals = np.array([geom[1] for geom in geometry[a0 : a0 + batch_size]])
+
+            # Excitation errors -(k0.g + g.g/2) / foil_normal.(k0 + g) for the whole batch
+            with np.errstate(divide="ignore", invalid="ignore"):
+                sg = -(k0 @ g_vec + g_half_sq) / (
+                    np.einsum("ij,ij->i", normals, k0)[:, None] + normals @ g_vec
+                )
+
+            # Diffracted peak intensities, with the envelope evaluated only for the candidates
+            # of each pattern. Candidates are tracked by flat index into the (batch, Ng)
+            # array, so each selection step is a single 1D gather.
+            inds = np.flatnonzero(np.abs(sg) <= sg_max)
+            g_int = (
+                struct_factors_int[inds % inds_g.size]
+                * np.exp(sg.ravel()[inds] ** 2 / (-2 * sigma_excitation_error ** 2))
+            ).astype("float32")
+            keep_int = g_int > tol_intensity
+            inds_pattern, inds_peak = np.divmod(inds[keep_int], inds_g.size)
+            inds_peak = inds_g[inds_peak]
+            g_int = g_int[keep_int]
+
+            # Split the kept peaks into one PointList per pattern
+            bounds = np.searchsorted(inds_pattern, np.arange(k0.shape[0] + 1))
+            for a1 in range(k0.shape[0]):
+                sub = slice(bounds[a1], bounds[a1 + 1])
+                bragg_peaks.append(
+                    self._diffraction_pattern_pointlist(
+                        geometry[a0 + a1][2], inds_peak[sub], g_int[sub]
+                    )
+                )
+
+        return bragg_peaks
+
+    def _diffraction_pattern_geometry(self, zone_axis, foil_normal, proj_x_axis):
+        """
+        Returns the wavevector, unit foil normal and (2,3) projection basis of a diffraction
+        pattern, from the zone axis (or 3x3 orientation matrix), foil normal and x axis.
+        """
+
         zone_axis = np.asarray(zone_axis, dtype="float")
 
         if zone_axis.ndim == 1:
             zone_axis = np.asarray(zone_axis)
-            zone_axis = zone_axis / np.linalg.norm(zone_axis)
+            zone_axis = _normalize(zone_axis)
 
             if not self.cartesian_directions:
                 zone_axis = self.cartesian_to_crystal(zone_axis)
@@ -2619,11 +2913,7 @@ class Crystal:
             zone_axis = zone_axis[:, 2, 0]
 
         # Set x and y projection vectors
-        ky_proj = np.cross(zone_axis, proj_x_axis)
-        kx_proj = np.cross(ky_proj, zone_axis)
-
-        kx_proj = kx_proj / np.linalg.norm(kx_proj)
-        ky_proj = ky_proj / np.linalg.norm(ky_proj)
+        k_proj = _projection_basis(tuple(zone_axis), tuple(proj_x_axis))
 
         # Foil normal vector
         if foil_normal is None:
@@ -2633,7 +2923,7 @@ class Crystal:
             if not self.cartesian_directions:
                 foil_normal = self.crystal_to_cartesian(foil_normal)
             else:
-                foil_normal = foil_normal / np.linalg.norm(foil_normal)
+                foil_normal = _normalize(foil_normal)
 
         # if proj_x_axis is None:
         #     if np.all(zone_axis == np.array([-1, 0, 0])):
@@ -2655,60 +2945,40 @@ class Crystal:
         # ky_proj = ky_proj / np.linalg.norm(ky_proj)
 
         # wavevector
-        zone_axis_norm = zone_axis / np.linalg.norm(zone_axis)
+        zone_axis_norm = _normalize(zone_axis)
         k0 = zone_axis_norm / self.wavelength
 
-        # Excitation errors
-        cos_alpha = np.sum(
-            (k0[:, None] + self.g_vec_all) * foil_normal[:, None], axis=0
-        ) / np.linalg.norm(k0[:, None] + self.g_vec_all, axis=0)
-        sg = (
-            (-0.5)
-            * np.sum((2 * k0[:, None] + self.g_vec_all) * self.g_vec_all, axis=0)
-            / (np.linalg.norm(k0[:, None] + self.g_vec_all, axis=0))
-            / cos_alpha
-        )
-
-        # Threshold for inclusion in diffraction pattern
-        sg_max = sigma_excitation_error * tol_excitation_error_mult
-        keep = np.abs(sg) <= sg_max
-        g_diff = self.g_vec_all[:, keep]
+        return k0, foil_normal, k_proj
 
-        # Diffracted peak intensities and labels
-        g_int = self.struct_factors_int[keep] * np.exp(
-            sg[keep] ** 2 / (-2 * sigma_excitation_error ** 2)
-        )
-        hkl = self.hkl[:, keep]
+    def _diffraction_pattern_pointlist(self, k_proj, keep, g_int):
+        """
+        Returns the PointList of the Bragg peaks with indices keep into the structure factors,
+        projected onto the basis k_proj, with diffracted intensities g_int.
+        """
 
-        # Intensity tolerance
-        keep_int = g_int > tol_intensity
+        # Output as PointList, filled field by field in a single structured array
+        coordinates = [
+            ("qx", "float64"),
+            ("qy", "float64"),
+            ("intensity", "float64"),
+            ("h", "int"),
+            ("k", "int"),
+            ("l", "int"),
+        ]
+        data = np.empty(keep.size, dtype=coordinates)
 
         # Diffracted peak locations
         # scale = 1/cos_alpha[keep]
-        kx_proj = kx_proj / np.linalg.norm(kx_proj)
-        ky_proj = ky_proj / np.linalg.norm(ky_proj)
-        gx_proj = np.sum(g_diff[:, keep_int] * kx_proj[:, None], axis=0)
-        gy_proj = np.sum(g_diff[:, keep_int] * ky_proj[:, None], axis=0)
-
-        # Diffracted peak labels
-        h = hkl[0, keep_int]
-        k = hkl[1, keep_int]
-        l = hkl[2, keep_int]
-
-        # Output as PointList
-        bragg_peaks = PointList(
-            [
-                ("qx", "float64"),
-                ("qy", "float64"),
-                ("intensity", "float64"),
-                ("h", "int"),
-                ("k", "int"),
-                ("l", "int"),
-            ]
-        )
-        bragg_peaks.add_pointarray(
-            np.vstack((gx_proj, gy_proj, g_int[keep_int], h, k, l)).T
-        )
+        data["qx"], data["qy"] = k_proj @ self.g_vec_all[:, keep]
+
+        # Diffracted peak intensities and labels
+        data["intensity"] = g_int
+        data["h"], data["k"], data["l"] = self.hkl[:, keep]
+
+        # The structured array is freshly allocated here, so the PointList takes it as is
+        bragg_peaks = PointList(coordinates)
+        bragg_peaks.data = data
+        bragg_peaks.length = data.shape[0]
 
         return bragg_peaks
 
@@ -2785,12 +3055,13 @@ class Crystal:
             p2_sub = self.orientation_zone_axis_range[2, :] - p2_proj
             B = np.vstack((self.orientation_zone_axis_range[0, :], p1_sub, p2_sub)).T
 
-        # initalize image arrays
-        images_orientation = np.zeros(
-            (orientation_matrices.shape[0], orientation_matrices.shape[1], 3, 3)
-        )
+        # Orientation matrices for all probe positions, shape (Rx, Ry, 3, 3)
+        if orientation_matrices.ndim == 4:
+            orient_all = orientation_matrices
+        else:
+            orient_all = orientation_matrices[:, :, :, :, orientation_index_plot]
 
-        # in-plane rotation array if needed
+        # in-plane rotation if needed
         if orientation_rotate_xy is not None:
             m = np.array(
                 [
@@ -2799,70 +3070,67 @@ class Crystal:
                     [0, 0, 1],
                 ]
             )
+            orient_all = np.einsum("ij,xyjk->xyik", m, orient_all)
 
-        # loop over all pixels and calculate weights
-        for ax in range(orientation_matrices.shape[0]):
-            for ay in range(orientation_matrices.shape[1]):
-                if orientation_matrices.ndim == 4:
-                    orient = orientation_matrices[ax, ay, :, :]
-                else:
-                    orient = orientation_matrices[ax, ay, :, :, orientation_index_plot]
-
-                # Rotate in-plane if needed
-                if orientation_rotate_xy is not None:
-                    orient = m @ orient
-
-                if self.orientation_fiber:
-                    # in-plane rotation
-                    # w = np.linalg.solve(A, orient[:, 0])
-                    w = np.linalg.solve(B, orient[:, 0])
-
-                    h = np.mod(
-                        np.arctan2(w[2], w[1])
-                        * 180
-                        / np.pi
-                        / self.orientation_fiber_angles[1],
-                        1,
-                    )
-                    w0 = np.maximum(1 - 3 * np.abs(np.mod(3 / 6 - h, 1) - 1 / 2), 0)
-                    w1 = np.maximum(1 - 3 * np.abs(np.mod(5 / 6 - h, 1) - 1 / 2), 0)
-                    w2 = np.maximum(1 - 3 * np.abs(np.mod(7 / 6 - h, 1) - 1 / 2), 0)
-                    w_scale = 1 / (1 - np.exp(-np.max((w0, w1, w2))))
-
-                    rgb = (
-                        color_basis[0, :] * w0 * w_scale
-                        + color_basis[1, :] * w1 * w_scale
-                        + color_basis[2, :] * w2 * w_scale
-                    )
-                    images_orientation[ax, ay, :, 0] = rgb
-
-                    # zone axis
-                    w = np.linalg.solve(A, orient[:, 2])
-                    w = w / (1 - np.exp(-np.max(w)))
-                    rgb = (
-                        color_basis[0, :] * w[0]
-                        + color_basis[1, :] * w[1]
-                        + color_basis[2, :] * w[2]
-                    )
-                    images_orientation[ax, ay, :, 2] = rgb
+        # calculate weights for all pixels, using the inverse of the fitting
+        # basis unless it is too poorly conditioned to invert directly
+        def fit_weights(basis, rhs):
+            if np.linalg.cond(basis) < 1e12:
+                return np.linalg.inv(basis) @ rhs
+            return np.linalg.solve(basis, rhs)
 
-                else:
-                    for a0 in range(3):
-                        # Cubic sorting for now - needs to be updated with symmetries
-                        # w = np.linalg.solve(A,orient[:,a0])
-                        w = np.linalg.solve(A, np.sort(np.abs(orient[:, a0])))
-                        # w = np.linalg.solve(A, orient[:, a0])
-                        w = w / (1 - np.exp(-np.max(w)))
-
-                        rgb = (
-                            color_basis[0, :] * w[0]
-                            + color_basis[1, :] * w[1]
-                            + color_basis[2, :] * w[2]
-                        )
-                        images_orientation[ax, ay, :, a0] = rgb
+        if self.orientation_fiber:
+            images_orientation = np.zeros(
+                (orientation_matrices.shape[0], orientation_matrices.shape[1], 3, 3)
+            )
+
+            # in-plane rotation
+            w = fit_weights(B, orient_all[:, :, :, 0:1])[..., 0]
+            h = np.mod(
+                np.arctan2(w[..., 2], w[..., 1])
+                * 180
+                / np.pi
+                / self.orientation_fiber_angles[1],
+                1,
+            )
+            w0 = np.maximum(1 - 3 * np.abs(np.mod(3 / 6 - h, 1) - 1 / 2), 0)
+            w1 = np.maximum(1 - 3 * np.abs(np.mod(5 / 6 - h, 1) - 1 / 2), 0)
+            w2 = np.maximum(1 - 3 * np.abs(np.mod(7 / 6 - h, 1) - 1 / 2), 0)
+            w = np.stack((w0, w1, w2), axis=-1)
+            w /= 1 - np.exp(-np.max(w, axis=-1, keepdims=True))
+            images_orientation[:, :, :, 0] = w @ color_basis
+
+            # zone axis
+            w = fit_weights(A, orient_all[:, :, :, 2:3])
+            w /= 1 - np.exp(-np.max(w, axis=-2, keepdims=True))
+            images_orientation[:, :, :, 2] = w[..., 0] @ color_basis
+
+        elif np.linalg.cond(A) < 1e12:
+            # Cubic sorting for now - needs to be updated with symmetries
+            images_orientation = np.zeros(
+                (orientation_matrices.shape[0], orientation_matrices.shape[1], 3, 3)
+            )
+            # Lookup table of the weight rescaling 1 - exp(-w) over the typical range of
+            # the largest corner weight, linearly interpolated by the kernel
+            w_lut = np.linspace(0.25, 4.0, 4096)
+            _orientation_map_colors(
+                images_orientation,
+                np.ascontiguousarray(orient_all, dtype="float64"),
+                np.linalg.inv(A),
+                color_basis,
+                1 - np.exp(-w_lut),
+                w_lut[0],
+                1 / (w_lut[1] - w_lut[0]),
+            )
 
-        # clip range
-        images_orientation = np.clip(images_orientation, 0, 1)
+        else:
+            # Cubic sorting for now - needs to be updated with symmetries
+            w = np.linalg.solve(A, np.sort(np.abs(orient_all), axis=-2))
+            w /= 1 - np.exp(-np.max(w, axis=-2, keepdims=True))
+            images_orientation = color_basis.T @ w
+
+        # clip range, in place since images_orientation is always a new array here
+        np.clip(images_orientation, 0, 1, out=images_orientation)
 
         # Masking
         if corr_all is not None:
@@ -2880,11 +3148,9 @@ class Crystal:
                     mask = corr_all[:, :, orientation_index_plot]
 
             mask = (mask - corr_range[0]) / (corr_range[1] - corr_range[0])
-            mask = np.clip(mask, 0, 1)
+            np.clip(mask, 0, 1, out=mask)
 
-            for a0 in range(3):
-                for a1 in range(3):
-                    images_orientation[:, :, a0, a1] *= mask
+            np.multiply(images_orientation, mask[:, :, None, None], out=images_orientation)
 
         # Draw legend for zone axis
         x = np.linspace(0, 1, leg_size[0])
@@ -2903,15 +3169,8 @@ class Crystal:
         w1 = w1 / w_scale  # * mask_legend
         w2 = w2 / w_scale  # * mask_legend
 
-        im_legend = np.zeros((leg_size[0], leg_size[1], 3))
-        for a0 in range(3):
-            im_legend[:, :, a0] = (
-                w0 * color_basis[0, a0]
-                + w1 * color_basis[1, a0]
-                + w2 * color_basis[2, a0]
-            )
-            im_legend[:, :, a0] *= mask_legend
-            im_legend[:, :, a0] += 1 - mask_legend
+        im_legend = np.stack((w0, w1, w2), axis=-1) @ color_basis
+        im_legend = np.where(mask_legend[:, :, None], im_legend, 1)
         im_legend = np.clip(im_legend, 0, 1)
 
         if self.orientation_fiber:
@@ -2936,15 +3195,8 @@ class Crystal:
             w1 = w1 / w_scale  # * mask_legend
             w2 = w2 / w_scale  # * mask_legend
 
-            inplane_legend = np.zeros((leg_size[0], leg_size[1], 3))
-            for a0 in range(3):
-                inplane_legend[:, :, a0] = (
-                    w0 * color_basis[0, a0]
-                    + w1 * color_basis[1, a0]
-                    + w2 * color_basis[2, a0]
-                )
-                inplane_legend[:, :, a0] *= mask_legend
-                inplane_legend[:, :, a0] += 1 - mask_legend
+            inplane_legend = np.stack((w0, w1, w2), axis=-1) @ color_basis
+            inplane_legend = np.where(mask_legend[:, :, None], inplane_legend, 1)
             inplane_legend = np.clip(inplane_legend, 0, 1)
 
         # plotting
@@ -3081,7 +3333,7 @@ class Crystal:
         return vec_cart / np.linalg.norm(vec_cart)
 
     def crystal_to_cartesian(self, vec_cart):
-        zone_axis = vec_cart @ np.linalg.inv(self.lat_real)
+        zone_axis = vec_cart @ self.lat_inv
         return zone_axis / np.linalg.norm(zone_axis)
 
 
@@ -3187,31 +3439,409 @@ def plot_diffraction_pattern(
             "size": 10,
         }
 
-        def overline(x):
-            return str(x) if x >= 0 else (r"\overline{" + str(np.abs(x)) + "}")
-
-        for a0 in range(bragg_peaks.data.shape[0]):
-            h = bragg_peaks.data["h"][a0]
-            k = bragg_peaks.data["k"][a0]
-            l = bragg_peaks.data["l"][a0]
+        # Label positions and strings for all peaks
+        x_labels = bragg_peaks.data["qy"]
+        y_labels = (
+            bragg_peaks.data["qx"] - shift_labels - shift_marker * np.sqrt(marker_size)
+        )
+        # Format each distinct Miller index once, with an overline for negative values
+        hkl = (bragg_peaks.data["h"], bragg_peaks.data["k"], bragg_peaks.data["l"])
+        overline = {
+            x: str(x) if x >= 0 else (r"\overline{" + str(-x) + "}")
+            for x in np.unique(np.concatenate(hkl)).tolist()
+        }
+        labels = [
+            "$" + overline[h] + overline[k] + overline[l] + "$"
+            for h, k, l in zip(*(x.tolist() for x in hkl))
+        ]
 
-            ax.text(
-                bragg_peaks.data["qy"][a0],
-                bragg_peaks.data["qx"][a0]
-                - shift_labels
-                - shift_marker * np.sqrt(marker_size[a0]),
-                "$" + overline(h) + overline(k) + overline(l) + "$",
-                **text_params,
-            )
+        for x, y, label in zip(x_labels, y_labels, labels):
+            ax.text(x, y, label, **text_params)
 
     # Force plot to have 1:1 aspect ratio
     ax.set_aspect("equal")
 
-    if input_fig_handle is None:
-        plt.show()
-
     if returnfig:
         return fig, ax
+    elif input_fig_handle is None:
+        plt.show()
+
+
+# Numba accelerated excitation errors and intensities of all structure factors for a single
+# incident wavevector. Structure factors too weak to pass the intensity tolerance, or outside
+# the excitation error tolerance, are rejected before the Gaussian envelope is evaluated.
+# The g vectors are independent, and are processed in parallel by _excitation_error_intensity.
+def _excitation_error_intensity_g(
+    g_int,
+    keep,
+    g_vec_all,
+    struct_factors_int,
+    k0,
+    foil_normal,
+    sg_max,
+    sigma_excitation_error,
+    tol_intensity,
+):
+    k0_x, k0_y, k0_z = k0[0], k0[1], k0[2]
+    n_x, n_y, n_z = foil_normal[0], foil_normal[1], foil_normal[2]
+    sg_scale = -0.5 / sigma_excitation_error ** 2
+
+    # Projection of the incident wavevector onto the foil normal, shared by all g vectors
+    k0_n = n_x * k0_x + n_y * k0_y + n_z * k0_z
+
+    for a0 in nb.prange(g_vec_all.shape[1]):
+        keep[a0] = False
+
+        # The envelope is at most 1, so structure factors at or below the intensity
+        # tolerance can never be kept
+        if struct_factors_int[a0] <= tol_intensity:
+            continue
+
+        g_x, g_y, g_z = g_vec_all[0, a0], g_vec_all[1, a0], g_vec_all[2, a0]
+
+        # Excitation error -(k0.g + g.g/2) / (|k0 + g| * cos_alpha), where the
+        # denominator reduces to foil_normal.(k0 + g)
+        denom = k0_n + n_x * g_x + n_y * g_y + n_z * g_z
+        if denom == 0:
+            continue
+        sg = -(
+            k0_x * g_x + k0_y * g_y + k0_z * g_z + 0.5 * (g_x * g_x + g_y * g_y + g_z * g_z)
+        ) / denom
+        if abs(sg) > sg_max:
+            continue
+
+        # Diffracted peak intensity
+        g_int[a0] = struct_factors_int[a0] * np.exp(sg_scale * sg ** 2)
+        keep[a0] = g_int[a0] > tol_intensity
+
+
+# The parallel kernel, and a serial version for calls from worker threads, where concurrent
+# launches of a parallel kernel are not supported by every numba threading layer
+_excitation_error_intensity = nb.njit(parallel=True, fastmath=True)(_excitation_error_intensity_g)
+_excitation_error_intensity_serial = nb.njit(fastmath=True)(_excitation_error_intensity_g)
+
+
+# Numba accelerated orientation map colors, in parallel over the probe positions. For each
+# of the 3 orientation axes, the sorted absolute direction cosines are fit to the corners of
+# the orientation triangle with the inverse fitting basis, rescaled and mixed into RGB. The
+# rescaling is read from a lookup table of 1 - exp(-w) sampled from scale_lut_start.
+@nb.njit(parallel=True, fastmath=True)
+def _orientation_map_colors(
+    images_orientation,
+    orientation_matrices,
+    basis_inv,
+    color_basis,
+    scale_lut,
+    scale_lut_start,
+    scale_lut_inv_step,
+):
+    for ax in nb.prange(orientation_matrices.shape[0]):
+        for ay in range(orientation_matrices.shape[1]):
+            for a0 in range(3):
+                # Cubic sorting of the absolute direction cosines
+                v0 = abs(orientation_matrices[ax, ay, 0, a0])
+                v1 = abs(orientation_matrices[ax, ay, 1, a0])
+                v2 = abs(orientation_matrices[ax, ay, 2, a0])
+                if v0 > v1:
+                    v0, v1 = v1, v0
+                if v1 > v2:
+                    v1, v2 = v2, v1
+                if v0 > v1:
+                    v0, v1 = v1, v0
+
+                # Weights of the 3 corners
+                w0 = basis_inv[0, 0] * v0 + basis_inv[0, 1] * v1 + basis_inv[0, 2] * v2
+                w1 = basis_inv[1, 0] * v0 + basis_inv[1, 1] * v1 + basis_inv[1, 2] * v2
+                w2 = basis_inv[2, 0] * v0 + basis_inv[2, 1] * v1 + basis_inv[2, 2] * v2
+
+                # Rescaling 1 / (1 - exp(-max(w))), from the lookup table where it applies
+                w_max = max(w0, w1, w2)
+                t = (w_max - scale_lut_start) * scale_lut_inv_step
+                if t >= 0 and t < scale_lut.size - 1:
+                    ind = int(t)
+                    w_scale = 1 / (
+                        scale_lut[ind] + (t - ind) * (scale_lut[ind + 1] - scale_lut[ind])
+                    )
+                else:
+                    w_scale = 1 / (1 - np.exp(-w_max))
+
+                for a1 in range(3):
+                    images_orientation[ax, ay, a1, a0] = w_scale * (
+                        w0 * color_basis[0, a1]
+                        + w1 * color_basis[1, a1]
+                        + w2 * color_basis[2, a1]
+                    )
+
+
+# Numba accelerated calculation of the orientation reference arrays for a set of zone
+# axes. For each zone axis, the excitation error and in-plane angle of every structure
+# factor are computed, and its correlation kernel is accumulated onto the polar
+# (radial shell, in-plane angle) grid. All inputs are expected in single precision.
+@nb.njit(parallel=True, fastmath=True)
+def _orientation_ref_build(
+    ref,
+    rotation_matrices,
+    g_vec_all,
+    k0_z,
+    shell_index,
+    radius_g,
+    weight_g,
+    gamma,
+    kernel_size,
+):
+    # Single precision constants, so that all arithmetic stays in float32
+    pi = np.float32(np.pi)
+    two_pi = np.float32(2 * np.pi)
+    half = np.float32(0.5)
+    two = np.float32(2)
+    one = np.float32(1)
+
+    # Spacing of the regular in-plane angle grid
+    dgamma = two_pi / gamma.size
+
+    for a0 in nb.prange(rotation_matrices.shape[0]):
+        # Hold the inverse rotation matrix in scalars, so each rotated scattering vector
+        # is computed on the fly without a (3, num_g) buffer per zone axis. The rotation
+        # matrices are orthonormal, so the inverse is read as the transpose.
+        m00, m01, m02 = rotation_matrices[a0, 0, 0], rotation_matrices[a0, 1, 0], rotation_matrices[a0, 2, 0]
+        m10, m11, m12 = rotation_matrices[a0, 0, 1], rotation_matrices[a0, 1, 1], rotation_matrices[a0, 2, 1]
+        m20, m21, m22 = rotation_matrices[a0, 0, 2], rotation_matrices[a0, 1, 2], rotation_matrices[a0, 2, 2]
+        for a1 in range(shell_index.size):
+            ind_radial = shell_index[a1]
+            if ind_radial >= 0:
+                # Rotated scattering vector
+                g_x, g_y, g_z = g_vec_all[0, a1], g_vec_all[1, a1], g_vec_all[2, a1]
+                p_x = m00 * g_x + m01 * g_y + m02 * g_z
+                p_y = m10 * g_x + m11 * g_y + m12 * g_z
+                p_z = m20 * g_x + m21 * g_y + m22 * g_z
+
+                # Excitation error, where |k0 + p| * cos_alpha reduces to the z component of k0 + p
+                sg = -half * (p_x ** 2 + p_y ** 2 + (p_z + two * k0_z) * p_z) / (p_z + k0_z)
+
+                # in-plane rotation angle
+                phi = np.arctan2(p_y, p_x)
+
+                # The kernel is nonzero only where (dphi * radius)^2 < kernel_size^2 - sg^2
+                half_width_sq = kernel_size ** 2 - sg ** 2
+                if half_width_sq <= 0:
+                    continue
+
+                # Range of in-plane angle bins within the kernel support, padded by one bin
+                radius = radius_g[a1]
+                half_width = np.sqrt(half_width_sq) / radius
+                a2_lo = int(np.floor((phi - half_width) / dgamma)) - 1
+                a2_hi = int(np.ceil((phi + half_width) / dgamma)) + 1
+                if a2_hi - a2_lo >= gamma.size:
+                    a2_lo = 0
+                    a2_hi = gamma.size - 1
+
+                weight = weight_g[a1]
+                for a2_unwrap in range(a2_lo, a2_hi + 1):
+                    a2 = a2_unwrap % gamma.size
+                    dphi = (gamma[a2] - phi + pi) % two_pi - pi
+                    w = one - np.sqrt(sg ** 2 + (dphi * radius) ** 2) / kernel_size
+                    if w > 0:
+                        ref[a0, ind_radial, a2] += weight * w
+
+
+def _polar_image_buffer(shape):
+    """
+    Returns the float32 polar Bragg peak image buffer of the calling thread with the given
+    shape, allocating it on first use or when the orientation plan shape changes.
+    """
+    buffer = getattr(_polar_image_buffers, "im_polar", None)
+    if buffer is None or buffer.shape != shape:
+        buffer = np.zeros(shape, dtype="float32")
+        _polar_image_buffers.im_polar = buffer
+    return buffer
+
+
+# Numba accelerated calculation of the polar Bragg peak image of a single diffraction
+# pattern. Each radial shell sums the correlation kernels of all peaks within the kernel
+# size, and is scaled by the shell radius and the maximum intensity of those peaks. The
+# peaks are sorted by radius once, so each shell only visits the peaks within its window.
+# The radial shells are independent, and are processed in parallel by _polar_image_build.
+def _polar_image_build_shells(
+    im_polar,
+    qr,
+    qphi,
+    intensity,
+    shell_radii,
+    gamma,
+    kernel_size,
+    radial_power,
+    intensity_power,
+):
+    two_pi = 2 * np.pi
+    inv_two_pi = 1 / two_pi
+    kernel_size_sq = kernel_size ** 2
+
+    # Spacing of the regular in-plane angle grid
+    dgamma = two_pi / gamma.size
+
+    # Peaks in order of increasing radius
+    order = np.argsort(qr)
+    qr_sort = qr[order]
+    qphi_sort = qphi[order]
+    intensity_sort = intensity[order]
+
+    for a0 in nb.prange(shell_radii.size):
+        radius = shell_radii[a0]
+        num_peaks = 0
+        intensity_max = 0.0
+        ind_start = np.searchsorted(qr_sort, radius - kernel_size)
+        ind_stop = np.searchsorted(qr_sort, radius + kernel_size, side="right")
+        for a1 in range(ind_start, ind_stop):
+            dqr = abs(qr_sort[a1] - radius)
+            if dqr < kernel_size:
+                if num_peaks == 0 or intensity_sort[a1] > intensity_max:
+                    intensity_max = intensity_sort[a1]
+                num_peaks += 1
+
+                # Range of in-plane angle bins within the kernel support, padded by one bin
+                half_width = np.sqrt(kernel_size_sq - dqr ** 2) / radius
+                a2_lo = int(np.floor((qphi_sort[a1] - half_width) / dgamma)) - 1
+                a2_hi = int(np.ceil((qphi_sort[a1] + half_width) / dgamma)) + 1
+                if a2_hi - a2_lo >= gamma.size:
+                    a2_lo = 0
+                    a2_hi = gamma.size - 1
+
+                for a2_unwrap in range(a2_lo, a2_hi + 1):
+                    a2 = a2_unwrap % gamma.size
+
+                    # Wrap the angle difference by rounding to the nearest period, and
+                    # only take the square root inside the kernel support
+                    dphi = gamma[a2] - qphi_sort[a1]
+                    dphi -= two_pi * np.round(dphi * inv_two_pi)
+                    d_sq = dqr ** 2 + (dphi * radius) ** 2
+                    if d_sq < kernel_size_sq:
+                        im_polar[a0, a2] += 1 - np.sqrt(d_sq) / kernel_size
+
+        if num_peaks > 0:
+            scale = radius ** radial_power * intensity_max ** intensity_power
+            for a2 in range(gamma.size):
+                im_polar[a0, a2] *= scale
+
+
+# Parallel version over radial shells for single-threaded callers, and a serial version for
+# callers that are already parallel over diffraction patterns, such as the worker threads
+# of match_orientations, which avoids nesting the numba thread pool inside them
+_polar_image_build = nb.njit(parallel=True, fastmath=True)(_polar_image_build_shells)
+_polar_image_build_serial = nb.njit(fastmath=True)(_polar_image_build_shells)
+
+
+# CUDA version of _orientation_ref_build, compiled with cupy.RawKernel when
+# orientation_plan is called with CUDA=True. Each block handles one zone axis and each
+# thread one or more in-plane angle bins, looping over all structure factors, so that no
+# two threads write to the same reference array element.
+_orientation_ref_build_cuda = r'''
+extern "C" __global__
+void orientation_ref_build(float *ref, const float *rotation_matrices, const float *g_vec_all,
+                const float k0_z, const long long *shell_index, const float *radius_g,
+                const float *weight_g, const float *gamma, const float kernel_size,
+                const long long num_g, const long long num_shells, const long long num_gamma){
+    const float pi = 3.14159265358979f;
+    const float two_pi = 6.28318530717959f;
+    const long long a0 = blockIdx.x;
+    const float *m = rotation_matrices + 9 * a0;
+
+    for (long long a2 = threadIdx.x; a2 < num_gamma; a2 += blockDim.x) {
+        for (long long a1 = 0; a1 < num_g; a1++) {
+            const long long ind_radial = shell_index[a1];
+            if (ind_radial < 0) continue;
+
+            // Rotated scattering vector, using the transpose as the inverse rotation
+            const float g_x = g_vec_all[a1];
+            const float g_y = g_vec_all[num_g + a1];
+            const float g_z = g_vec_all[2 * num_g + a1];
+            const float p_x = m[0] * g_x + m[3] * g_y + m[6] * g_z;
+            const float p_y = m[1] * g_x + m[4] * g_y + m[7] * g_z;
+            const float p_z = m[2] * g_x + m[5] * g_y + m[8] * g_z;
+
+            // Excitation error, skipping structure factors outside the kernel support
+            const float sg = -0.5f * (p_x * p_x + p_y * p_y + (p_z + 2.0f * k0_z) * p_z) / (p_z + k0_z);
+            if (kernel_size * kernel_size - sg * sg <= 0.0f) continue;
+
+            // Wrapped in-plane angle difference
+            float dphi = fmodf(gamma[a2] - atan2f(p_y, p_x) + pi, two_pi);
+            if (dphi < 0.0f) dphi += two_pi;
+            dphi -= pi;
+
+            const float radius = radius_g[a1];
+            const float w = 1.0f - sqrtf(sg * sg + dphi * radius * dphi * radius) / kernel_size;
+            if (w > 0.0f) {
+                ref[(a0 * num_shells + ind_radial) * num_gamma + a2] += weight_g[a1] * w;
+            }
+        }
+    }
+}
+'''
+
+
+# CUDA version of _polar_image_build for a batch of diffraction patterns, compiled with
+# cupy.RawKernel when match_orientations_batched is called with CUDA=True. The peaks of all
+# patterns are concatenated, with peak_offsets giving the range for each pattern. Each block
+# handles one (pattern, radial shell) pair and each thread one or more in-plane angle bins.
+_polar_image_build_cuda = r'''
+extern "C" __global__
+void polar_image_build(float *im_polar, const float *qr, const float *qphi,
+                const float *intensity, const long long *peak_offsets, const float *shell_radii,
+                const float *gamma, const float kernel_size, const float radial_power,
+                const float intensity_power, const long long num_radii, const long long num_gamma){
+    const float two_pi = 6.28318530717959f;
+    const long long a0 = blockIdx.x;
+    const long long ind_radial = blockIdx.y;
+    const float radius = shell_radii[ind_radial];
+    float *row = im_polar + (a0 * num_radii + ind_radial) * num_gamma;
+
+    for (long long a2 = threadIdx.x; a2 < num_gamma; a2 += blockDim.x) {
+        float val = 0.0f;
+        float intensity_max = 0.0f;
+        long long num_peaks = 0;
+        for (long long a1 = peak_offsets[a0]; a1 < peak_offsets[a0 + 1]; a1++) {
+            const float dqr = fabsf(qr[a1] - radius);
+            if (dqr >= kernel_size) continue;
+            if (num_peaks == 0 || intensity[a1] > intensity_max) intensity_max = intensity[a1];
+            num_peaks++;
+
+            // Wrap the angle difference by rounding to the nearest period, and only take
+            // the square root inside the kernel support
+            float dphi = gamma[a2] - qphi[a1];
+            dphi -= two_pi * rintf(dphi / two_pi);
+            const float d_sq = dqr * dqr + dphi * radius * dphi * radius;
+            if (d_sq < kernel_size * kernel_size) val += 1.0f - sqrtf(d_sq) / kernel_size;
+        }
+        if (num_peaks > 0) {
+            row[a2] = val * powf(radius, radial_power) * powf(intensity_max, intensity_power);
+        }
+    }
+}
+'''
+
+
+@functools.lru_cache(maxsize=1024)
+def _projection_basis(zone_axis, proj_x_axis):
+    """
+    Returns the read-only (2,3) array of unit x and y projection vectors for a diffraction
+    pattern, given the zone axis and x axis as tuples. Cached, since scans and orientation
+    searches project many patterns along the same directions.
+    """
+    zone_axis = _normalize(np.array(zone_axis))
+    ky_proj = _normalize(np.cross(zone_axis, proj_x_axis))
+
+    # The cross product of two orthogonal unit vectors is already unit length
+    kx_proj = np.cross(ky_proj, zone_axis)
+    k_proj = np.vstack((kx_proj, ky_proj))
+    k_proj.flags.writeable = False
+    return k_proj
+
+
+def _normalize(v):
+    """
+    Returns the 3 element vector v scaled to unit length, using a single reciprocal
+    square root of v.v in place of np.linalg.norm and a division.
+    """
+    return v * (1 / math.sqrt(v[0] * v[0] + v[1] * v[1] + v[2] * v[2]))
 
 
 def axisEqual3D(ax):
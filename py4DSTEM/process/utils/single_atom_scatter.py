@@ -1,5 +1,17 @@
 import numpy as np
 import os
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def _load_scattering_factors():
+    """
+    Load the Lobato parameterization table once per session, shared by all instances.
+    The table is returned read-only, so no instance can modify it for the others.
+    """
+    path = os.path.join(os.path.dirname(__file__),'scattering_factors.txt')
+    e_scattering_factors = np.loadtxt(path,dtype=float)
+    e_scattering_factors.flags.writeable = False
+    return e_scattering_factors
 
 class single_atom_scatter(object):
     """
@@ -18,8 +30,7 @@ class single_atom_scatter(object):
         self.composition = composition
         self.q_coords = q_coords
         self.units = units
-        path = os.path.join(os.path.dirname(__file__),'scattering_factors.txt')
-        self.e_scattering_factors = np.loadtxt(path,dtype=np.float)
+        self.e_scattering_factors = _load_scattering_factors()
 
         return
 
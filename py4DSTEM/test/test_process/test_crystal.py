@@ -0,0 +1,82 @@
+# Tests for the crystal orientation matching module
+
+import unittest
+import numpy as np
+from py4DSTEM.io.datastructure import PointListArray
+from py4DSTEM.process.diffraction import Crystal
+
+class TestOrientationMatching(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        # Au FCC crystal with a coarse orientation plan
+        positions = np.array([[0.0,0.0,0.0],[0.5,0.5,0.0],[0.5,0.0,0.5],[0.0,0.5,0.5]])
+        cls.crystal = Crystal(positions, 79, 4.08)
+        cls.crystal.calculate_structure_factors(1.5)
+        cls.crystal.orientation_plan(
+            zone_axis_range=np.array([[0,1,1],[1,1,1]]),
+            angle_step_zone_axis=5,
+            angle_step_in_plane=10,
+            progress_bar=False,
+        )
+
+        # Simulated Bragg peaks for a small scan of random orientations
+        cls.bragg_peaks = PointListArray(
+            [("qx","float64"),("qy","float64"),("intensity","float64")], (3,4))
+        rng = np.random.default_rng(0)
+        for rx in range(3):
+            for ry in range(4):
+                bp = cls.crystal.generate_diffraction_pattern(np.abs(rng.normal(size=3)))
+                pl = cls.bragg_peaks.get_pointlist(rx,ry)
+                data = np.empty(bp.length, dtype=pl.dtype)
+                for name in ("qx","qy","intensity"):
+                    data[name] = bp.data[name]
+                pl.add_dataarray(data)
+
+    def test_match_orientations_threads(self):
+        # Multiple matches also simulate the fitted patterns from the worker threads
+        for num_matches_return in (1, 3):
+            orientation_matrices, corr = self.crystal.match_orientations(
+                self.bragg_peaks, num_matches_return=num_matches_return,
+                return_corr=True, progress_bar=False)
+            orientation_matrices_threads, corr_threads = self.crystal.match_orientations(
+                self.bragg_peaks, num_matches_return=num_matches_return,
+                return_corr=True, progress_bar=False, num_threads=3)
+            self.assertTrue(np.array_equal(orientation_matrices, orientation_matrices_threads))
+            self.assertTrue(np.array_equal(corr, corr_threads))
+
+    def test_match_orientations_batched(self):
+        for inversion_symmetry in (True, False):
+            orientation_matrices, corr = self.crystal.match_orientations(
+                self.bragg_peaks, inversion_symmetry=inversion_symmetry,
+                return_corr=True, progress_bar=False)
+            for batch_size in (1, 5):
+                orientation_matrices_batched, corr_batched = self.crystal.match_orientations_batched(
+                    self.bragg_peaks, inversion_symmetry=inversion_symmetry,
+                    return_corr=True, batch_size=batch_size, progress_bar=False)
+                self.assertTrue(np.allclose(orientation_matrices, orientation_matrices_batched))
+                self.assertTrue(np.allclose(corr, corr_batched))
+
+    def test_generate_diffraction_patterns(self):
+        rng = np.random.default_rng(1)
+        zone_axes = rng.normal(size=(20,3))
+        orientation_matrices = np.linalg.qr(rng.normal(size=(5,3,3)))[0]
+        for zone_axes, kwargs in (
+            (zone_axes, {}),
+            (zone_axes, {"batch_size":7, "tol_intensity":0.0}),
+            (zone_axes, {"foil_normal":[0.0,0.1,1.0]}),
+            (orientation_matrices, {}),
+        ):
+            bragg_peaks_batched = self.crystal.generate_diffraction_patterns(zone_axes, **kwargs)
+            kwargs.pop("batch_size", None)
+            self.assertEqual(len(bragg_peaks_batched), len(zone_axes))
+            for zone_axis, bp_batched in zip(zone_axes, bragg_peaks_batched):
+                bp = self.crystal.generate_diffraction_pattern(zone_axis, **kwargs)
+                self.assertEqual(bp.length, bp_batched.length)
+                for name in bp.dtype.names:
+                    self.assertTrue(np.allclose(bp.data[name], bp_batched.data[name]))
+
+
+if __name__=='__main__':
+    unittest.main()